@@ -0,0 +1,192 @@
+from dataclasses import MISSING, dataclass, field, fields
+from datetime import time
+
+REQUIRED = MISSING
+
+
+class ConfigError(ValueError):
+    """
+    Raised at startup if the arguments of an app are invalid. Contains all errors, not just the first one.
+    """
+    def __init__(self, app, errors):
+        self.errors = errors
+        super().__init__("Invalid configuration of {}:\n- {}".format(app, "\n- ".join(errors)))
+
+
+"""
+Converters. They get the raw value from the apps.yaml and raise ValueError or TypeError if it is invalid.
+"""
+def integer(value):
+    try:
+        if not isinstance(value, bool) and float(value).is_integer():
+            return int(float(value))
+    except (TypeError, ValueError):
+        pass
+    raise ValueError("expected an integer, got {!r}".format(value))
+
+
+def number(value):
+    try:
+        if not isinstance(value, bool):
+            return float(value)
+    except (TypeError, ValueError):
+        pass
+    raise ValueError("expected a number, got {!r}".format(value))
+
+
+def boolean(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', 'on', 'yes', '1'):
+        return True
+    if str(value).lower() in ('false', 'off', 'no', '0'):
+        return False
+    raise ValueError("expected true or false, got {!r}".format(value))
+
+
+def text(value):
+    if not isinstance(value, str):
+        raise ValueError("expected a string, got {!r}".format(value))
+    return value
+
+
+def entity_id(value):
+    if not isinstance(value, str) or '.' not in value:
+        raise ValueError("expected an entity id (domain.name), got {!r}".format(value))
+    return value.strip().lower()
+
+
+def mapping(value):
+    if not isinstance(value, dict):
+        raise ValueError("expected a mapping, got {!r}".format(value))
+    return value
+
+
+def time_of_day(value):
+    """
+    Accepts 'HH:MM[:SS]' and the minutes YAML makes of an unquoted HH:MM (sexagesimal number).
+    """
+    if isinstance(value, time):
+        return value
+    if isinstance(value, int) and not isinstance(value, bool):
+        if not 0 <= value < 24 * 60:
+            raise ValueError("expected a time of the day, got {!r}".format(value))
+        return time(value // 60, value % 60)
+    try:
+        return time.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError("expected a time of the day (HH:MM), got {!r}".format(value)) from None
+
+
+def list_of(convert):
+    def convert_list(value):
+        if not isinstance(value, list):
+            raise ValueError("expected a list, got {!r}".format(value))
+        return [convert(item) for item in value]
+    return convert_list
+
+
+def one_of(*choices):
+    def convert(value):
+        if value not in choices:
+            raise ValueError("expected one of {}, got {!r}".format(", ".join(map(str, choices)), value))
+        return value
+    return convert
+
+
+@dataclass(slots=True, frozen=True)
+class Items:
+    """
+    Converter for a list of nested configurations (e.g. the devices), every item is read into 'cls'.
+    """
+    cls: type
+
+
+def option(convert, default=REQUIRED, name=None):
+    """
+    Declares a field of a config dataclass. 'name' is the argument in the apps.yaml if it differs from the field.
+    Missing and empty (null) arguments get the default, or are reported if there is none.
+    """
+    metadata = {'convert': convert, 'required': default is REQUIRED, 'name': name}
+    if isinstance(default, (list, dict)):
+        return field(default_factory=lambda: type(default)(default), metadata=metadata)
+    return field(default=None if default is REQUIRED else default, metadata=metadata)
+
+
+class ConfigLoader:
+    """
+    Reads the arguments into config dataclasses. Errors are collected instead of raised, so all of them
+    can be reported at once. Entity ids are collected as well, so they can be checked in one batch.
+    """
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+        self.entities = {}
+
+    def load(self, cls, args, path=''):
+        if not isinstance(args, dict):
+            self.errors.append("{}: expected a mapping, got {!r}".format(path.rstrip('.') or 'arguments', args))
+            return None
+
+        values = {}
+        known = set()
+        for config_field in fields(cls):
+            if 'convert' not in config_field.metadata:
+                continue
+            convert = config_field.metadata['convert']
+            name = config_field.metadata['name'] or config_field.name
+            key = path + name
+            known.add(name)
+
+            value = args.get(name)
+            if value is None:
+                if config_field.metadata['required']:
+                    self.errors.append("{}: missing".format(key))
+                continue
+
+            try:
+                if isinstance(convert, Items):
+                    if not isinstance(value, list):
+                        raise ValueError("expected a list, got {!r}".format(value))
+                    values[config_field.name] = [
+                        self.load(convert.cls, item, "{}[{}].".format(key, i)) for i, item in enumerate(value)
+                    ]
+                else:
+                    values[config_field.name] = convert(value)
+                    if convert is entity_id:
+                        self.entities[key] = values[config_field.name]
+            except (TypeError, ValueError) as e:
+                self.errors.append("{}: {}".format(key, e))
+
+        # The top level also contains the arguments of AppDaemon itself (module, class, ...)
+        if path:
+            for name in args.keys() - known:
+                self.warnings.append("{}{}: unknown argument".format(path, name))
+
+        config = cls(**values)
+        check = getattr(config, 'check', None)
+        if check is not None and not self.errors:
+            self.errors.extend(path + error for error in check())
+        return config
+
+
+def load_config(ad, cls):
+    """
+    Validates and converts the arguments of an app once at startup.
+    Raises a ConfigError with all errors. All entities are checked with a single state request; missing
+    entities are only logged, because Home Assistant might not have created them yet.
+    """
+    loader = ConfigLoader()
+    config = loader.load(cls, ad.args)
+    if loader.errors:
+        raise ConfigError(ad.name, loader.errors)
+
+    if loader.entities:
+        states = ad.get_state() or {}
+        for key, value in loader.entities.items():
+            if value not in states:
+                loader.warnings.append("{}: entity {} does not exist (yet)".format(key, value))
+
+    for warning in loader.warnings:
+        ad.log(warning, level="WARNING")
+    return config
@@ -0,0 +1,221 @@
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Config import boolean, integer, number, option
+
+DEFAULT_BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# All enabled Metrics instances by app name (rendered by the Prometheus endpoint)
+registry = {}
+servers = {}
+lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        :return: upper bound of the bucket that contains the quantile q (None if empty or above all buckets)
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+
+class NullMetrics:
+    """
+    Used when the metrics are disabled. All methods do nothing, so the instrumentation costs only a method call.
+    """
+    enabled = False
+
+    def inc(self, name, value=1):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def close(self):
+        pass
+
+
+class Metrics(NullMetrics):
+    """
+    Counters, gauges and histograms of an app. They can be published as Home Assistant sensors
+    (sensor.<app>_<metric>) and/or served in the Prometheus text format over HTTP.
+    """
+    enabled = True
+
+    def __init__(self, ad, publish_interval=None, port=None):
+        self.__ad = ad
+        self.name = ad.name
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.port = port
+
+        with lock:
+            registry[self.name] = self
+            if port is not None and port not in servers:
+                servers[port] = start_server(port)
+
+        if publish_interval:
+            ad.run_every(self.publish, start=f"now+{publish_interval}", interval=publish_interval)
+
+    def inc(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(value)
+
+    def close(self):
+        with lock:
+            registry.pop(self.name, None)
+            if self.port in servers and not any(metrics.port == self.port for metrics in registry.values()):
+                server = servers.pop(self.port)
+                server.shutdown()
+                server.server_close()
+
+    def entity_id(self, name):
+        return "sensor.{}_{}".format(self.name.lower(), name)
+
+    def publish(self, kwargs=None):
+        for name, value in list(self.counters.items()) + list(self.gauges.items()):
+            self.__ad.set_state(self.entity_id(name), state=value)
+
+        for name, histogram in list(self.histograms.items()):
+            self.__ad.set_state(self.entity_id(name), state=round(histogram.sum / histogram.count, 3), attributes={
+                'count': histogram.count,
+                'p50': histogram.quantile(0.5),
+                'p95': histogram.quantile(0.95),
+                'p99': histogram.quantile(0.99),
+            })
+
+    def render(self):
+        """
+        :return: the metrics in the Prometheus text format
+        """
+        label = 'app="{}"'.format(self.name)
+        lines = []
+        for name, value in list(self.counters.items()):
+            lines.append("appdaemon_{}_total{{{}}} {}".format(name, label, value))
+        for name, value in list(self.gauges.items()):
+            lines.append("appdaemon_{}{{{}}} {}".format(name, label, value))
+        for name, histogram in list(self.histograms.items()):
+            total = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                total += count
+                lines.append('appdaemon_{}_bucket{{{},le="{}"}} {}'.format(name, label, bound, total))
+            lines.append('appdaemon_{}_bucket{{{},le="+Inf"}} {}'.format(name, label, histogram.count))
+            lines.append("appdaemon_{}_sum{{{}}} {}".format(name, label, histogram.sum))
+            lines.append("appdaemon_{}_count{{{}}} {}".format(name, label, histogram.count))
+        return lines
+
+
+class InstrumentedApp:
+    """
+    Mixin for the apps (listed before hass.Hass): counts the state reads, times the ticks and logs debug messages.
+    """
+    metrics = NullMetrics()  # Until create_metrics() has been called
+    debug = False
+    debug_prefix = ""
+    last_tick_time = None
+
+    def clog(self, msg, *args):
+        # The message is only formatted if debugging is enabled
+        if self.debug:
+            self.log(self.debug_prefix + msg, *args)
+
+    def get_state(self, *args, **kwargs):
+        self.metrics.inc('state_reads')
+        return super().get_state(*args, **kwargs)
+
+    def timed_tick(self, tick, interval, *args):
+        """
+        Runs tick(*args) and measures its duration.
+        :param interval: expected seconds between two ticks for the lag, None if the ticks are not periodic
+        """
+        if not self.metrics.enabled:
+            return tick(*args)
+
+        now = self.get_now_ts()
+        if interval is not None and self.last_tick_time is not None:
+            # Time between two ticks exceeding the interval means that the loop falls behind
+            self.metrics.set('tick_lag_seconds', round(max(0.0, now - self.last_tick_time - interval), 3))
+        self.last_tick_time = now
+
+        start = time.perf_counter()
+        try:
+            return tick(*args)
+        finally:
+            self.metrics.observe('tick_duration_ms', (time.perf_counter() - start) * 1000)
+
+
+@dataclass(slots=True)
+class MetricsConfig:
+    """
+    Arguments of the metrics, the config dataclasses of the apps inherit them.
+    """
+    metrics: bool = option(boolean, False)
+    metrics_publish_interval: float = option(number, 60)  # Seconds, 0 = do not publish as sensors
+    metrics_port: int = option(integer, None)
+
+
+def create_metrics(ad, config):
+    """
+    Creates the metrics of an app from its validated config (see MetricsConfig).
+    """
+    if not config.metrics:
+        return NullMetrics()
+
+    return Metrics(ad, publish_interval=config.metrics_publish_interval, port=config.metrics_port)
+
+
+def start_server(port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                apps = list(registry.values())
+            body = "\n".join(line for app in apps for line in app.render()).encode() + b"\n"
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, name="Metrics-http", daemon=True).start()
+    return server
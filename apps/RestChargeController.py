@@ -1,108 +1,891 @@
 import hassapi as hass
+import csv
+import json
+import math
+import os
 import requests
+import threading
+import time
+from bisect import bisect_right
+from dataclasses import dataclass
+from datetime import time as time_of_day_type
+from Config import ConfigError, Items, boolean, entity_id, integer, load_config, mapping, number, one_of, option, text
+from Metrics import InstrumentedApp, MetricsConfig, create_metrics
+from SensorHub import parse_number, parse_timestamp
+from StateStore import StateStore
 
 # Variables
 block_battery = False
 
 
-class RestChargeController(hass.Hass):
+class ChargeTransport:
+    """
+    Sends the charge/discharge requests from a background thread over a persistent (keep-alive) session,
+    so the loop never blocks on the REST API.
+    Only the newest request is kept: if a new setpoint is sent while the previous one is still waiting,
+    the previous one is dropped.
+    """
+    def __init__(self, ad, headers, timeout=5, retries=2, retry_backoff=0.5):
+        self.__ad = ad
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__retry_backoff = retry_backoff
+
+        self.__session = requests.Session()
+        self.__session.headers.update(headers or {})
+
+        self.__condition = threading.Condition()
+        self.__pending = None
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__run, name="RestChargeController-transport", daemon=True)
+        self.__thread.start()
+
+    def send(self, url):
+        with self.__condition:
+            if self.__pending is not None:
+                self.__ad.metrics.inc('superseded_requests')
+                self.__ad.clog("Dropped superseded request %s.", self.__pending)
+            self.__pending = url
+            self.__condition.notify()
+
+    def stop(self):
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        self.__thread.join(timeout=self.__timeout)
+        self.__session.close()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while self.__pending is None and not self.__stopped:
+                    self.__condition.wait()
+                if self.__stopped:
+                    return
+                url = self.__pending
+                self.__pending = None
+
+            self.__post(url)
+
+    def __post(self, url):
+        metrics = self.__ad.metrics
+        for attempt in range(self.__retries + 1):
+            start = time.perf_counter()
+            try:
+                metrics.inc('http_requests')
+                response = self.__session.post(url, timeout=self.__timeout)
+                response.raise_for_status()
+                metrics.observe('http_latency_ms', (time.perf_counter() - start) * 1000)
+                return
+            except requests.RequestException as e:
+                metrics.inc('http_errors')
+                self.__ad.log("Request %s failed (attempt %s/%s): %s", url, attempt + 1, self.__retries + 1, e)
+
+            if attempt == self.__retries:
+                return
+
+            # Wait before retrying, but give up if the setpoint has been superseded in the meantime
+            with self.__condition:
+                self.__condition.wait_for(lambda: self.__pending is not None or self.__stopped,
+                                          timeout=self.__retry_backoff * 2 ** attempt)
+                if self.__pending is not None or self.__stopped:
+                    return
+
+
+class ChargeSmoother:
+    """
+    Control stage between the computed charge power and the power that is sent to the battery.
+    The base class passes the charge power through unchanged.
+    """
+    def __init__(self):
+        self.output = None
+
+    def reset(self, output=None):
+        self.output = output
+
+    def update(self, target, dt):
+        self.output = target
+        return target
+
+
+class RampLimiter(ChargeSmoother):
+    """
+    Limits how fast the charge power may change (max_ramp in W/s).
+    """
+    def __init__(self, max_ramp):
+        super().__init__()
+        self.max_ramp = max_ramp
+
+    def update(self, target, dt):
+        if self.output is None:
+            self.output = target
+        else:
+            max_step = self.max_ramp * dt
+            self.output += max(-max_step, min(max_step, target - self.output))
+        return self.output
+
+
+class EmaFilter(ChargeSmoother):
+    """
+    Exponential moving average of production minus consumption (time_constant in seconds).
+    """
+    def __init__(self, time_constant):
+        super().__init__()
+        self.time_constant = time_constant
+
+    def update(self, target, dt):
+        if self.output is None or self.time_constant <= 0:
+            self.output = target
+        else:
+            self.output += (1 - math.exp(-dt / self.time_constant)) * (target - self.output)
+        return self.output
+
+
+class PiController(ChargeSmoother):
+    """
+    PI controller (incremental form) targeting zero grid exchange.
+    The output is the setpoint that has been applied (the controller is reset to the power that has actually been
+    sent), so the target (production - consumption) minus the output is the measured grid exchange.
+
+    The integral step is normalized by the interval (1 - e^(-ki * dt), like the EMA filter), so it never exceeds
+    the error, and the output never overshoots the target. The controller is stable for every refresh_interval.
+    """
+    def __init__(self, kp, ki):
+        super().__init__()
+        self.kp = kp
+        self.ki = ki
+        self.last_error = None
+
+    def reset(self, output=None):
+        super().reset(output)
+        self.last_error = None
+
+    def update(self, target, dt):
+        if self.output is None:
+            self.output = target
+            return self.output
+
+        grid_power = target - self.output  # Positive = export
+        last_error = grid_power if self.last_error is None else self.last_error
+        step = self.kp * (grid_power - last_error) + (1 - math.exp(-self.ki * dt)) * grid_power
+        self.last_error = grid_power
+
+        # Clamp between the current setpoint and the target
+        self.output = max(min(self.output, target), min(max(self.output, target), self.output + step))
+        return self.output
+
+
+class Profile:
+    """
+    Step function over time, e.g. a tariff (EUR/kWh) or a production forecast (W). Every value is valid from its
+    time until the next one. Times are either dates (unix time or ISO string) or times of the day ('HH:MM'),
+    which repeat every day.
+    """
+    def __init__(self, values=None):
+        self.times = []
+        self.values = []
+        self.daily = False
+        self.end = float('inf')
+        if values:
+            self.update(values)
+
+    def update(self, values):
+        """
+        :param values: dict of time -> value, or list of dicts with the keys 'start'/'time' and 'value'/'price'/'watts'
+        """
+        if isinstance(values, list):
+            values = {
+                next(item[key] for key in ('start', 'time') if key in item):
+                next(item[key] for key in ('value', 'price', 'watts') if key in item)
+                for item in values
+            }
+
+        self.daily = any(isinstance(key, time_of_day_type) or (isinstance(key, str) and len(key) <= 8 and ':' in key)
+                         for key in values)
+        entries = sorted((self.parse_time(key), float(value)) for key, value in values.items())
+        self.times = [timestamp for timestamp, _ in entries]
+        self.values = [value for _, value in entries]
+
+        self.end = float('inf')
+        if not self.daily and self.times:
+            step = self.times[-1] - self.times[-2] if len(self.times) > 1 else 3600
+            self.end = self.times[-1] + step
+
+    def parse_time(self, value):
+        if self.daily:
+            parsed = value if isinstance(value, time_of_day_type) else time_of_day_type.fromisoformat(str(value))
+            return parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+        return parse_timestamp(value)
+
+    @property
+    def available(self):
+        return len(self.times) > 0
+
+    def at(self, timestamp, day_start, default=None):
+        """
+        :param day_start: timestamp of the local midnight before 'timestamp' (for daily profiles)
+        """
+        if not self.times:
+            return default
+        if self.daily:
+            index = bisect_right(self.times, (timestamp - day_start) % 86400) - 1
+            return self.values[index]  # Before the first time of the day: the last value of the previous day
+        if timestamp >= self.end:
+            return default
+        index = bisect_right(self.times, timestamp) - 1
+        return self.values[index] if index >= 0 else default
+
+
+class ChargePlanner:
+    """
+    Cost-optimal charge plan for a time-of-use tariff. Dynamic programming over time slots and state of charge
+    buckets: for every slot (backwards from the end of the horizon) and every bucket the cheapest target bucket at
+    the end of the slot is stored, so the plan also covers every state of charge the battery could deviate to.
+    Without a target the battery just follows the consumption like without a plan.
+
+    The rows are cached by slot. When the inputs change, only the slots up to the last changed one are computed
+    again, because a slot only depends on the slots after it. Passing time alone costs nothing.
+    """
+    def __init__(self, capacity, max_charge_power, max_discharge_power, slot_seconds=900, buckets=50,
+                 efficiency=0.95, stored_energy_value=0):
+        self.capacity = capacity
+        self.max_charge_power = max_charge_power
+        self.max_discharge_power = max_discharge_power
+        self.slot_seconds = slot_seconds
+        self.buckets = buckets
+        self.bucket_energy = capacity / buckets
+        self.efficiency = efficiency
+        self.stored_energy_value = stored_energy_value
+
+        self.end = None
+        self.rows = {}  # slot start -> (inputs, cost to go per bucket, target bucket per bucket)
+        self.computed_rows = 0
+        self.slot_energy = None  # (slot start, stored energy at the start of the slot)
+
+    def slot_start(self, timestamp):
+        return timestamp - timestamp % self.slot_seconds
+
+    def update(self, slots, end):
+        """
+        :param slots: list of (slot start, (import price, export price, net consumption in Wh)) until 'end'
+        :return: number of slots that have been computed
+        """
+        if end != self.end:
+            self.rows = {}
+            self.end = end
+
+        # Only the slots up to the last one with changed inputs have to be computed again
+        first_valid = len(slots)
+        for i in range(len(slots) - 1, -1, -1):
+            row = self.rows.get(slots[i][0])
+            if row is None or row[0] != slots[i][1]:
+                break
+            first_valid = i
+
+        start = slots[0][0] if slots else end
+        self.rows = {slot: row for slot, row in self.rows.items() if slot >= start}
+        if first_valid < len(slots):
+            cost_to_go = self.rows[slots[first_valid][0]][1]
+        else:
+            cost_to_go = [-b * self.bucket_energy * self.efficiency / 1000 * self.stored_energy_value
+                          for b in range(self.buckets + 1)]
+
+        for slot, inputs in reversed(slots[:first_valid]):
+            cost_to_go, targets = self.solve_slot(inputs, cost_to_go)
+            self.rows[slot] = (inputs, cost_to_go, targets)
+
+        self.computed_rows += first_valid
+        return first_valid
+
+    def solve_slot(self, inputs, next_cost):
+        import_price, export_price, net_energy = inputs
+        hours = self.slot_seconds / 3600
+        max_up = int(self.max_charge_power * hours * self.efficiency // self.bucket_energy)
+        max_down = int(self.max_discharge_power * hours // self.bucket_energy)
+
+        cost = [0.0] * (self.buckets + 1)
+        targets = [None] * (self.buckets + 1)
+        for b in range(self.buckets + 1):
+            # Following the consumption (storing the surplus or covering the deficit like the controller does
+            # without a plan, target None) is checked first, so it wins if there is no cheaper option.
+            # It usually ends between two buckets, the cost to go is interpolated then.
+            battery_energy = -net_energy * self.efficiency if net_energy < 0 else -net_energy / self.efficiency
+            stay = min(self.buckets, max(0, b + battery_energy / self.bucket_energy))
+            best_target = None
+            best_cost = self.slot_cost((stay - b) * self.bucket_energy, net_energy, import_price, export_price) \
+                + self.interpolate(next_cost, stay)
+            for target in range(max(0, b - max_down), min(self.buckets, b + max_up) + 1):
+                total = self.slot_cost((target - b) * self.bucket_energy, net_energy, import_price, export_price) \
+                    + next_cost[target]
+                if total < best_cost:
+                    best_target, best_cost = target, total
+            cost[b] = best_cost
+            targets[b] = best_target
+        return cost, targets
+
+    def interpolate(self, values, bucket):
+        lower = int(bucket)
+        if lower == bucket:
+            return values[lower]
+        return values[lower] + (values[lower + 1] - values[lower]) * (bucket - lower)
+
+    def slot_cost(self, stored_energy, net_energy, import_price, export_price):
+        battery_energy = stored_energy / self.efficiency if stored_energy > 0 else stored_energy * self.efficiency
+        grid_energy = net_energy + battery_energy
+        return grid_energy / 1000 * (import_price if grid_energy > 0 else export_price)
+
+    def power(self, timestamp, stored_energy):
+        """
+        :return: the planned charge power (W, negative = discharge) for the current slot, or None without a plan
+                 or if the plan is to follow the consumption
+        """
+        slot = self.slot_start(timestamp)
+        row = self.rows.get(slot)
+        if row is None:
+            return None
+
+        # The target is taken for the state of charge at the start of the slot, otherwise it would move along
+        # with the battery while charging
+        if self.slot_energy is None or self.slot_energy[0] != slot:
+            self.slot_energy = (slot, stored_energy)
+        position = min(self.buckets, max(0, self.slot_energy[1] / self.bucket_energy))
+        bucket = round(position)
+        target = row[2][bucket]
+        if target is None:
+            return None
+
+        target_energy = (target + position - bucket) * self.bucket_energy
+        remaining_hours = max(slot + self.slot_seconds - timestamp, 60) / 3600
+        power = (target_energy - stored_energy) / remaining_hours
+        power = power / self.efficiency if power > 0 else power * self.efficiency
+        return max(-self.max_discharge_power, min(self.max_charge_power, power))
+
+
+class Battery:
+    """
+    One battery (inverter) controlled by the RestChargeController. Every battery has its own transport,
+    so the commands to all inverters are sent concurrently.
+    """
+    def __init__(self, ad, name, sensor_battery_percentage, url_charge, url_discharge, url_headers,
+                 capacity=1, health=1, max_charge_power=None, max_discharge_power=None):
+        self.name = name
+        self.sensor_battery_percentage = sensor_battery_percentage
+        self.url_charge = url_charge
+        self.url_discharge = url_discharge
+        self.capacity = capacity
+        self.health = health
+        self.max_charge_power = max_charge_power
+        self.max_discharge_power = max_discharge_power
+
+        self.percentage = None
+        self.charge_limit_reached = False
+        self.transport = ChargeTransport(ad, url_headers, ad.url_timeout, ad.url_retries, ad.url_retry_backoff)
+
+    def weight(self, charging):
+        """
+        Share of the power this battery gets: the usable capacity that is still free (charging) or stored (discharging).
+        """
+        share = 100 - self.percentage if charging else self.percentage
+        return self.capacity * self.health * max(0, share)
+
+
+@dataclass(slots=True)
+class BatteryConfig:
+    name: str = option(text, None)
+    sensor_battery_percentage: str = option(entity_id)
+    url_charge: str = option(text)
+    url_discharge: str = option(text)
+    url_headers: dict = option(mapping, None)  # None = url_headers of the app
+    capacity: float = option(number, 1)
+    health: float = option(number, 1)
+    max_charge_power: int = option(integer, None)
+    max_discharge_power: int = option(integer, None)
+
+
+@dataclass(slots=True)
+class RestChargeConfig(MetricsConfig):
+    debug: bool = option(boolean, False)
+    sensor_production: str = option(entity_id)
+    sensor_consumption: str = option(entity_id)
+    switch_enable_control: str = option(entity_id)
+    switch_enable_battery: str = option(entity_id)
+    switch_limit_percentage: str = option(entity_id)
+    switch_only_charge: str = option(entity_id)
+    switch_only_discharge: str = option(entity_id)
+    sensor_hub: str = option(text, None)
+
+    battery_charge_limit: int = option(integer)
+    battery_recharge_threshold: int = option(integer)
+    battery_slow_charge_percentage: int = option(integer)
+    battery_slow_charge_max_power: int = option(integer)
+
+    # Single battery (without 'batteries')
+    sensor_battery_percentage: str = option(entity_id, None)
+    url_charge: str = option(text, None)
+    url_discharge: str = option(text, None)
+    batteries: list = option(Items(BatteryConfig), None)
+
+    battery_capacity: float = option(number, None)  # Wh of the single battery (needed for the charge plan)
+
+    url_headers: dict = option(mapping, {})
+    refresh_interval: float = option(number)
+    url_timeout: float = option(number, 5)
+    url_retries: int = option(integer, 2)
+    url_retry_backoff: float = option(number, 0.5)
+
+    charge_smoothing: str = option(one_of('none', 'ramp', 'ema', 'pi'), 'none')
+    charge_max_ramp: float = option(number, 200)
+    charge_ema_time_constant: float = option(number, 10)
+    charge_pi_kp: float = option(number, 0.3)
+    charge_pi_ki: float = option(number, 0.3)
+
+    # Charge plan for a time-of-use tariff
+    tariff_file: str = option(text, None)
+    tariff_sensor: str = option(entity_id, None)
+    tariff_attribute: str = option(text, 'prices')
+    feed_in_price: float = option(number, 0)
+    production_forecast_file: str = option(text, None)
+    production_forecast_sensor: str = option(entity_id, None)
+    production_forecast_attribute: str = option(text, 'watts')
+    consumption_profile_file: str = option(text, None)
+    consumption_profile_sensor: str = option(entity_id, None)
+    consumption_profile_attribute: str = option(text, 'watts')
+    plan_base_consumption: float = option(number, 300)
+    plan_slot_minutes: int = option(integer, 15)
+    plan_soc_buckets: int = option(integer, 50)
+    plan_efficiency: float = option(number, 0.95)
+    plan_max_power: float = option(number, 3000)
+    plan_stored_energy_value: float = option(number, None)
+    plan_refresh_interval: float = option(number, 300)
+
+    persistence_file: str = option(text, None)
+
+    def check(self):
+        errors = []
+        if self.tariff_file or self.tariff_sensor:
+            if self.batteries and any(battery.capacity <= 1 for battery in self.batteries):
+                errors.append("batteries: every battery needs its 'capacity' (Wh) for the charge plan")
+            if not self.batteries and not self.battery_capacity:
+                errors.append("battery_capacity: missing (needed for the charge plan)")
+            if not 0 < self.plan_efficiency <= 1:
+                errors.append("plan_efficiency: has to be greater than 0 and at most 1")
+            if self.plan_soc_buckets < 1 or self.plan_slot_minutes < 1:
+                errors.append("plan_soc_buckets, plan_slot_minutes: have to be at least 1")
+        if not self.batteries:
+            for name in ('sensor_battery_percentage', 'url_charge', 'url_discharge'):
+                if getattr(self, name) is None:
+                    errors.append("{}: missing (needed without 'batteries')".format(name))
+        if self.battery_recharge_threshold > self.battery_charge_limit:
+            errors.append("battery_recharge_threshold: has to be at most battery_charge_limit")
+        if self.refresh_interval <= 0:
+            errors.append("refresh_interval: has to be greater than 0")
+        if self.charge_smoothing == 'pi':
+            if not 0 <= self.charge_pi_kp < 1:
+                errors.append("charge_pi_kp: has to be at least 0 and less than 1")
+            if self.charge_pi_ki <= 0:
+                errors.append("charge_pi_ki: has to be greater than 0")
+        return errors
+
+
+class RestChargeController(InstrumentedApp, hass.Hass):
+    debug_prefix = "(DEBUG) "
 
     def initialize(self):
-        self.debug_enabled              = self.args['debug']
+        self.config                     = load_config(self, RestChargeConfig)
+        self.metrics                    = create_metrics(self, self.config)
+        self.debug                      = self.config.debug
 
-        self.sensor_battery_percentage  = self.args['sensor_battery_percentage']
-        self.sensor_production          = self.args['sensor_production']
-        self.sensor_consumption         = self.args['sensor_consumption']
-        self.switch_enable_control      = self.args['switch_enable_control']
-        self.switch_enable_battery      = self.args['switch_enable_battery']
-        self.switch_limit_percentage    = self.args['switch_limit_percentage']
-        self.switch_only_charge         = self.args['switch_only_charge']
-        self.switch_only_discharge      = self.args['switch_only_discharge']
+        self.sensor_production          = self.config.sensor_production
+        self.sensor_consumption         = self.config.sensor_consumption
+        self.switch_enable_control      = self.config.switch_enable_control
+        self.switch_enable_battery      = self.config.switch_enable_battery
+        self.switch_limit_percentage    = self.config.switch_limit_percentage
+        self.switch_only_charge         = self.config.switch_only_charge
+        self.switch_only_discharge      = self.config.switch_only_discharge
 
-        self.battery_charge_limit       = self.args['battery_charge_limit']
-        self.battery_recharge_threshold = self.args['battery_recharge_threshold']
-        self.battery_slow_charge_percentage = self.args['battery_slow_charge_percentage']
-        self.battery_slow_charge_max_power = self.args['battery_slow_charge_max_power']
+        self.battery_charge_limit       = self.config.battery_charge_limit
+        self.battery_recharge_threshold = self.config.battery_recharge_threshold
+        self.battery_slow_charge_percentage = self.config.battery_slow_charge_percentage
+        self.battery_slow_charge_max_power = self.config.battery_slow_charge_max_power
 
-        self.url_discharge              = self.args['url_discharge']
-        self.url_charge                 = self.args['url_charge']
-        self.url_headers                = self.args['url_headers']
-        self.refresh_interval           = self.args['refresh_interval']
+        self.url_headers                = self.config.url_headers
+        self.refresh_interval           = self.config.refresh_interval
+        self.url_timeout                = self.config.url_timeout
+        self.url_retries                = self.config.url_retries
+        self.url_retry_backoff          = self.config.url_retry_backoff
 
-        self.charge_limit_reached       = False
+        # Production, consumption and battery percentages can be read from a shared SensorHub app
+        self.sensor_hub                 = self.get_app(self.config.sensor_hub) if self.config.sensor_hub else None
+        if self.config.sensor_hub and self.sensor_hub is None:
+            raise ConfigError(self.name, ["sensor_hub: app {} is not running".format(self.config.sensor_hub)])
+
+        self.smoother                   = self.create_smoother()
+        self.store                      = StateStore(self.config.persistence_file, self.name) if self.config.persistence_file else None
+        self.last_loop_time             = None
+        self.batteries                  = self.create_batteries()
+
+        if self.store is not None:
+            data, saved_at = self.store.load()
+            if data is not None:
+                charge_limit_reached = data['charge_limit_reached']
+                for battery in self.batteries:
+                    if isinstance(charge_limit_reached, dict):
+                        battery.charge_limit_reached = charge_limit_reached.get(battery.name, False)
+                    else:
+                        battery.charge_limit_reached = charge_limit_reached
+                self.log("Restored state (charge limit reached: {}).".format(charge_limit_reached))
+
+        # The first values of the profile sensors are read while the planner is created, the first plan is
+        # computed by the timer afterwards. Later changes of the sensors update the plan directly.
+        self.planner                    = self.create_planner()
+        for name, (sensor, attribute) in self.profile_sensors.items():
+            self.listen_state(self.profile_sensor_changed, sensor, attribute=attribute, profile=name)
 
         # Run all x seconds
         self.run_every(self.loop, start="now+2", interval=self.refresh_interval)
 
-    def mylog(self, text):
-        if self.debug_enabled:
-            self.log("(DEBUG) " + text)
+    def create_batteries(self):
+        """
+        Creates the batteries from the 'batteries' list. Without it, the top level arguments
+        describe a single battery.
+        """
+        raw_batteries = self.config.batteries or [BatteryConfig(
+            name='battery',
+            sensor_battery_percentage=self.config.sensor_battery_percentage,
+            url_charge=self.config.url_charge,
+            url_discharge=self.config.url_discharge,
+            capacity=self.config.battery_capacity or 1,
+        )]
+
+        batteries = []
+        for i, raw_battery in enumerate(raw_batteries):
+            batteries.append(
+                Battery(
+                    ad=self,
+                    name=raw_battery.name or "battery_{}".format(i + 1),
+                    sensor_battery_percentage=raw_battery.sensor_battery_percentage,
+                    url_charge=raw_battery.url_charge,
+                    url_discharge=raw_battery.url_discharge,
+                    url_headers=raw_battery.url_headers if raw_battery.url_headers is not None else self.url_headers,
+                    capacity=raw_battery.capacity,
+                    health=raw_battery.health,
+                    max_charge_power=raw_battery.max_charge_power,
+                    max_discharge_power=raw_battery.max_discharge_power,
+                )
+            )
+        return batteries
+
+    def create_smoother(self):
+        match self.config.charge_smoothing:
+            case 'ramp':
+                return RampLimiter(self.config.charge_max_ramp)
+            case 'ema':
+                return EmaFilter(self.config.charge_ema_time_constant)
+            case 'pi':
+                return PiController(kp=self.config.charge_pi_kp, ki=self.config.charge_pi_ki)
+            case _:
+                return ChargeSmoother()
+
+    def create_planner(self):
+        """
+        Creates the charge planner if a tariff is configured. The plan is updated every 'plan_refresh_interval'
+        seconds and when one of the sensors changes, the loop only looks it up.
+        """
+        config = self.config
+        self.profiles = {}
+        self.profile_files = {}
+        self.profile_sensors = {}
+        if not (config.tariff_file or config.tariff_sensor):
+            return None
+
+        for name in ('tariff', 'production_forecast', 'consumption_profile'):
+            self.profiles[name] = Profile()
+            file = getattr(config, name + '_file')
+            sensor = getattr(config, name + '_sensor')
+            if file:
+                self.profile_files[name] = [file, None]
+            elif sensor:
+                attribute = getattr(config, name + '_attribute')
+                self.profile_sensors[name] = (sensor, attribute)
+                self.read_profile(name, self.get_state(sensor, attribute=attribute))
+
+        planner = ChargePlanner(
+            capacity=sum(battery.capacity * battery.health for battery in self.batteries),
+            max_charge_power=sum(battery.max_charge_power or config.plan_max_power for battery in self.batteries),
+            max_discharge_power=sum(battery.max_discharge_power or config.plan_max_power for battery in self.batteries),
+            slot_seconds=config.plan_slot_minutes * 60,
+            buckets=config.plan_soc_buckets,
+            efficiency=config.plan_efficiency,
+            stored_energy_value=config.plan_stored_energy_value
+            if config.plan_stored_energy_value is not None else config.feed_in_price,
+        )
+        self.run_every(self.update_plan, start="now+1", interval=config.plan_refresh_interval)
+        return planner
 
-    def block_battery(self):
-        self.charge_battery(5) # Permanently charge with 5W to prevent battery draining
+    def profile_sensor_changed(self, entity, attribute, old, new, kwargs):
+        if self.read_profile(kwargs['profile'], new):
+            self.update_plan()
+
+    def read_profile(self, name, values):
+        """
+        :return: True if the profile has been updated from the state of its sensor
+        """
+        if not isinstance(values, (dict, list)):
+            return False
+        try:
+            self.profiles[name].update(values)
+        except (TypeError, ValueError, KeyError, StopIteration) as e:
+            self.log("Could not read {} from sensor: {}".format(name, e))
+            return False
+        return True
+
+    def load_profile_files(self):
+        """
+        Loads the profile files (JSON object of time -> value or CSV with a 'time' column and the value in the
+        second column) that have been changed since the last update.
+        """
+        for name, (file, mtime) in self.profile_files.items():
+            try:
+                current_mtime = os.path.getmtime(file)
+                if current_mtime == mtime:
+                    continue
+                with open(file, newline='') as f:
+                    if file.endswith('.csv'):
+                        rows = list(csv.reader(f))
+                        values = {row[0]: row[1] for row in rows[1:] if len(row) > 1}
+                    else:
+                        values = json.load(f)
+                self.profiles[name].update(values)
+                self.profile_files[name][1] = current_mtime
+            except (OSError, ValueError, KeyError, StopIteration) as e:
+                self.log("Could not load {} from {}: {}".format(name, file, e))
+
+    def update_plan(self, kwargs=None):
+        """
+        Updates the inputs of all slots until the end of tomorrow (or the end of the tariff) and computes
+        the slots whose inputs have changed.
+        """
+        self.load_profile_files()
+        tariff = self.profiles['tariff']
+        if not tariff.available:
+            return
+
+        now = self.get_now_ts()
+        local_now = self.datetime()
+        day_start = now - (local_now.hour * 3600 + local_now.minute * 60 + local_now.second)
+        end = min(day_start + 2 * 86400, tariff.end)
+
+        planner = self.planner
+        slot_hours = planner.slot_seconds / 3600
+        slots = []
+        slot = planner.slot_start(now)
+        while slot < end:
+            # The current slot has already started, its inputs are the ones from now on
+            at = max(slot, now)
+            production = self.profiles['production_forecast'].at(at, day_start, 0)
+            consumption = self.profiles['consumption_profile'].at(at, day_start, self.config.plan_base_consumption)
+            price = tariff.at(at, day_start)
+            if price is None:
+                break
+            slots.append((slot, (price, self.config.feed_in_price, round((consumption - production) * slot_hours, 1))))
+            slot += planner.slot_seconds
+
+        if not slots:
+            return
+
+        computed = planner.update(slots, end)
+        self.metrics.inc('plan_updates')
+        self.metrics.inc('plan_slots_computed', computed)
+        self.clog("Updated charge plan (%s of %s slots computed).", computed, len(slots))
+
+    def planned_power(self):
+        """
+        :return: the charge power of the plan for the current state of charge, or None without a plan
+        """
+        if self.planner is None:
+            return None
+        stored_energy = sum(battery.capacity * battery.health * battery.percentage / 100 for battery in self.batteries)
+        power = self.planner.power(self.get_now_ts(), stored_energy)
+        if power is not None:
+            self.metrics.set('planned_power', round(power))
+        return power
+
+    def terminate(self):
+        for battery in self.batteries:
+            battery.transport.stop()
+        if self.store is not None:
+            self.store.close()
+        self.metrics.close()
+
+    def read_number(self, entity_id):
+        """
+        :return: the value of a sensor (from the hub if configured), None if it is unavailable
+        """
+        if self.sensor_hub is not None:
+            return self.sensor_hub.value(entity_id)
+        return parse_number(self.get_state(entity_id))
+
+    def block_battery(self, battery=None):
+        """
+        Blocks the given battery or all batteries.
+        """
+        for blocked_battery in ([battery] if battery is not None else self.batteries):
+            self.charge_battery(5, blocked_battery) # Permanently charge with 5W to prevent battery draining
+
+        if battery is None:
+            self.smoother.reset(5 * len(self.batteries))
 
     """
     power: negative = discharge; positive = charge
     """
-    def charge_battery(self, power):
+    def charge_battery(self, power, battery=None):
+        battery = battery if battery is not None else self.batteries[0]
         if power > 0:
-            self.mylog("Charging battery with {} W.".format(str(power)))
-            request = requests.post(self.url_charge.format(str(power)), headers=self.url_headers)
+            self.clog("Charging %s with %s W.", battery.name, power)
+            battery.transport.send(battery.url_charge.format(str(power)))
         else:
             power = abs(power)  # This device only accepts positive numbers (url needs to be changed for charge/discharge)
-            self.mylog("Discharging battery with {} W.".format(str(power)))
-            request = requests.post(self.url_discharge.format(str(power)), headers=self.url_headers)
+            self.clog("Discharging %s with %s W.", battery.name, power)
+            battery.transport.send(battery.url_discharge.format(str(power)))
+
+    def max_power(self, battery, charging):
+        if charging:
+            max_power = battery.max_charge_power
+            # charge slower if nearly full
+            if battery.percentage >= self.battery_slow_charge_percentage:
+                max_power = min(max_power or self.battery_slow_charge_max_power, self.battery_slow_charge_max_power)
+            return max_power if max_power is not None else float('inf')
+        return battery.max_discharge_power if battery.max_discharge_power is not None else float('inf')
+
+    def split_power(self, power, batteries):
+        """
+        Splits the charge power over the batteries, weighted by their capacity, health and percentage.
+        The share a battery cannot take because of its maximum power is passed on to the other batteries.
+
+        @returns dict of battery -> power
+        """
+        charging = power > 0
+        powers = {battery: 0.0 for battery in batteries}
+        remaining = abs(power)
+        active = list(batteries)
+
+        while remaining >= 1 and active:
+            weights = [battery.weight(charging) for battery in active]
+            total = sum(weights)
+            if total <= 0:
+                weights, total = [1] * len(active), len(active)
+
+            unlimited = []
+            for battery, weight in zip(active, weights):
+                share = remaining * weight / total
+                limit = self.max_power(battery, charging) - powers[battery]
+                if share < limit:
+                    unlimited.append(battery)
+                powers[battery] += min(share, limit)
+
+            remaining = abs(power) - sum(powers.values())
+            if len(unlimited) == len(active):
+                break
+            active = unlimited
+
+        sign = 1 if charging else -1
+        return {battery: sign * round(battery_power) for battery, battery_power in powers.items()}
 
     def loop(self, kwargs=None):
-        self.mylog("----------")
+        now = self.get_now_ts()
+        dt = now - self.last_loop_time if self.last_loop_time is not None else self.refresh_interval
+        self.last_loop_time = now
+
+        self.timed_tick(self.control, self.refresh_interval, dt)
+
+    def control(self, dt):
+        self.clog("----------")
+
         # Cancel if this script is disabled
         if self.get_state(self.switch_enable_control) == 'off':
-            self.mylog("Battery-Script is disabled.")
+            self.clog("Battery-Script is disabled.")
+            self.smoother.reset()
             return
 
         # Block charge/discharge battery if battery is disabled
         if self.get_state(self.switch_enable_battery) == 'off':
-            self.mylog("Battery is disabled.")
+            self.clog("Battery is disabled.")
             self.block_battery()
             return
 
-        # Battery control is active - initialize sensors
-        battery_percentage = int(self.get_state(self.sensor_battery_percentage))
-        production = int(self.get_state(self.sensor_production))
-        consumption = int(self.get_state(self.sensor_consumption))
+        # Battery control is active - initialize sensors (shared by all batteries)
+        production = self.read_number(self.sensor_production)
+        consumption = self.read_number(self.sensor_consumption)
+        percentages = [self.read_number(battery.sensor_battery_percentage) for battery in self.batteries]
+        if production is None or consumption is None or None in percentages:
+            # Do not charge or discharge blindly
+            self.metrics.inc('sensor_unavailable')
+            self.clog("A sensor is unavailable.")
+            self.block_battery()
+            return
+
+        production, consumption = int(production), int(consumption)
+        for battery, percentage in zip(self.batteries, percentages):
+            battery.percentage = int(percentage)
+
+        # The charge plan can require charging from the grid (cheap tariff) or holding the energy (expensive tariff later)
+        planned_power = self.planned_power()
+        planned_charge = planned_power is not None and planned_power > max(0, production - consumption)
 
         # Block charge/discharge battery if percentage is limited
         if self.get_state(self.switch_limit_percentage) == 'on':
-            if battery_percentage >= self.battery_charge_limit:
-                self.charge_limit_reached = True
+            for battery in self.batteries:
+                if battery.percentage >= self.battery_charge_limit:
+                    battery.charge_limit_reached = True
 
-            if battery_percentage <= self.battery_recharge_threshold:
-                self.charge_limit_reached = False
+                if battery.percentage <= self.battery_recharge_threshold:
+                    battery.charge_limit_reached = False
+
+            if self.store is not None:
+                self.store.save({'charge_limit_reached': {battery.name: battery.charge_limit_reached
+                                                          for battery in self.batteries}})
 
         # Prevent discharging (only allow charge)
         if self.get_state(self.switch_only_charge) == 'on':
-            if production <= consumption:
-                self.mylog("Battery is not allowed to discharge.")
+            if production <= consumption and not planned_charge:
+                self.clog("Battery is not allowed to discharge.")
                 self.block_battery()
                 return
 
         # Prevent charging (only allow discharge)
-        if self.get_state(self.switch_only_discharge) == 'on' or self.charge_limit_reached:
-            if production >= consumption:
-                self.mylog("Battery is not allowed to charge.")
+        batteries = self.batteries
+        if production >= consumption or planned_charge:
+            only_discharge = self.get_state(self.switch_only_discharge) == 'on'
+            batteries = [battery for battery in self.batteries if not (only_discharge or battery.charge_limit_reached)]
+            if not batteries:
+                self.clog("Battery is not allowed to charge.")
                 self.block_battery()
                 return
 
-        # charge slower if nearly full
+            for battery in self.batteries:
+                if battery not in batteries:
+                    self.clog("%s is not allowed to charge.", battery.name)
+                    self.block_battery(battery)
+
         charge_power = production - (consumption + 5)  # Permanently add 5W to consumption to have some buffer before importing power from the grid
 
-        if battery_percentage >= self.battery_slow_charge_percentage and charge_power > self.battery_slow_charge_max_power:
-            charge_power = self.battery_slow_charge_max_power
+        # Track the plan: charge at least the planned power, discharge at most the planned power
+        if planned_power is not None:
+            charge_power = max(charge_power, round(planned_power))
+
+        # Smooth out battery charging (e.g. no instantaneous switch from charging with 2000W to discharging 2000W)
+        charge_power = round(self.smoother.update(charge_power, dt))
+
+        # Split the power over the batteries (charge slower if nearly full)
+        powers = self.split_power(charge_power, batteries)
+        split_power = sum(powers.values())
+        if abs(split_power - charge_power) > len(batteries):
+            self.smoother.reset(split_power)
 
         # If this point in the script is reached, there are no more restrictions.
         # Battery can be freely controlled now.
-        # TODO smooth out battery charging (do not allow instantaneous (example) switch from charging with 2000W to discharging 2000W, which would be a 4000W difference)
         # TODO slower charging in the morning (somehow check if it is a sunny day). In the winter most of the time all power is needed that it can get. But if it's a sunny day it has enough time to charge slower.
-        self.charge_battery(charge_power)
+        for battery, power in powers.items():
+            self.charge_battery(power, battery)
 
-        self.mylog("----------")
\ No newline at end of file
+        self.clog("----------")
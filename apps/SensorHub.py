@@ -0,0 +1,159 @@
+import hassapi as hass
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from Config import entity_id, list_of, load_config, number, option
+from Metrics import MetricsConfig, create_metrics
+
+
+@dataclass(slots=True)
+class SensorReading:
+    value: float  # None if the sensor is unavailable or not numeric
+    state: str  # Raw state
+    updated: float  # Timestamp of the last report of the sensor (also if the value has not changed)
+    checked: float = None  # Timestamp of the last state request because the reading was stale
+
+
+def parse_number(state):
+    """
+    :return: the state as float, None for 'unavailable', 'unknown' and other non-numeric states
+    """
+    try:
+        return float(state)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_timestamp(value):
+    """
+    :return: unix time of a number, a numeric string (JSON keys are always strings), a datetime or an ISO string
+    """
+    if isinstance(value, datetime):
+        return value.timestamp()
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(str(value)).timestamp()
+
+
+@dataclass(slots=True)
+class SensorHubConfig(MetricsConfig):
+    sensors: list = option(list_of(entity_id), [])
+    max_age: float = option(number, 0)
+
+
+class SensorHub(hass.Hass):
+    """
+    Keeps the current values of the (power) sensors used by several apps. Every sensor is subscribed to once,
+    its state is parsed when it changes and all apps read the same typed value without a state request.
+
+    Apps get the hub with get_app() (argument 'sensor_hub' of the consuming app). Sensors are registered
+    on first use or in advance with the argument 'sensors'. Values of unavailable sensors and of sensors that
+    have not reported for 'max_age' seconds (0 = never stale) are returned as None (or the given default).
+
+    Home Assistant sends no state event if a sensor reports the same value again (e.g. 0 W production all night).
+    Before a reading counts as stale, the state is requested once and its 'last_reported' is checked. Without
+    'last_reported' (Home Assistant before 2024.3) a sensor that still has a state counts as alive.
+    """
+    def initialize(self):
+        config = load_config(self, SensorHubConfig)
+        self.metrics = create_metrics(self, config)
+        self.max_age = config.max_age
+
+        self.readings = {}
+        self.subscribers = {}
+        self.lock = threading.RLock()
+
+        for sensor in config.sensors:
+            self.register(sensor)
+
+        self.log("SensorHub initialized with {} sensors.".format(len(self.readings)))
+
+    def terminate(self):
+        self.metrics.close()
+
+    def register(self, entity_id, callback=None):
+        """
+        Subscribes to the sensor (only the first time) and optionally adds a callback(entity_id, reading)
+        that is called every time the value of the sensor changes.
+
+        :return: the current reading
+        """
+        with self.lock:
+            reading = self.readings.get(entity_id)
+            if reading is None:
+                reading = self.readings[entity_id] = self.parse(self.get_state(entity_id, attribute="all"))
+                self.listen_state(self.sensor_changed, entity_id, attribute="all")
+            if callback is not None:
+                self.subscribers.setdefault(entity_id, []).append(callback)
+            return reading
+
+    def unsubscribe(self, callback):
+        """
+        Removes the callback from all sensors, has to be called when the consuming app terminates.
+        """
+        with self.lock:
+            for callbacks in self.subscribers.values():
+                while callback in callbacks:
+                    callbacks.remove(callback)
+
+    def parse(self, state):
+        if state is None:
+            return SensorReading(None, None, self.get_now_ts())
+
+        last_reported = state.get('last_reported') or state.get('last_updated')
+        return SensorReading(
+            value=parse_number(state.get('state')),
+            state=state.get('state'),
+            updated=self.convert_utc(last_reported).timestamp() if last_reported else self.get_now_ts(),
+        )
+
+    def sensor_changed(self, entity, attribute, old, new, kwargs):
+        reading = self.parse(new)
+        with self.lock:
+            previous = self.readings.get(entity)
+            self.readings[entity] = reading
+            callbacks = list(self.subscribers.get(entity, ()))
+
+        self.metrics.inc('sensor_updates')
+        if reading.value is None:
+            self.metrics.inc('unavailable_readings')
+
+        if previous is None or previous.value != reading.value:
+            for callback in callbacks:
+                callback(entity, reading)
+
+    def reading(self, entity_id):
+        reading = self.readings.get(entity_id)
+        return reading if reading is not None else self.register(entity_id)
+
+    def is_stale(self, reading):
+        return self.max_age > 0 and self.get_now_ts() - reading.updated > self.max_age
+
+    def refresh(self, entity_id):
+        """
+        Requests the state of a sensor that has not sent an event for 'max_age' seconds (at most once per 'max_age').
+        """
+        state = self.get_state(entity_id, attribute="all")
+        reading = self.parse(state)
+        reading.checked = self.get_now_ts()
+        if state is not None and 'last_reported' not in state and reading.value is not None:
+            reading.updated = reading.checked
+
+        self.metrics.inc('stale_refreshes')
+        with self.lock:
+            self.readings[entity_id] = reading
+        return reading
+
+    def value(self, entity_id, default=None):
+        """
+        :return: the current value of the sensor, or the default if it is unavailable or stale
+        """
+        reading = self.reading(entity_id)
+        if reading.value is not None and self.is_stale(reading):
+            if reading.checked is None or self.get_now_ts() - reading.checked > self.max_age:
+                reading = self.refresh(entity_id)
+            if self.is_stale(reading):
+                self.metrics.inc('stale_readings')
+                return default
+        return reading.value if reading.value is not None else default
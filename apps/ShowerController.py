@@ -1,5 +1,10 @@
 import hassapi as hass
+import heapq
+from dataclasses import dataclass
 from enum import Enum
+from Config import Items, boolean, entity_id, integer, load_config, option, text
+from Metrics import InstrumentedApp, MetricsConfig, create_metrics
+from StateStore import StateStore
 
 
 class State(Enum):
@@ -10,7 +15,128 @@ class State(Enum):
     GET_OUT = 5
 
 
-class ShowerController(hass.Hass):
+class Event(Enum):
+    TRIGGER = 1  # trigger_entity changed
+    CANCEL = 2  # cancel_entity changed
+    TIMEOUT = 3  # Timeout of the current state reached
+    PREPARED = 4  # shower_prepare_state is on
+    NOT_PREPARED = 5  # shower_prepare_state is off
+
+
+# Allowed transitions: state -> {event -> next state}. Events without an entry do not change the state.
+TRANSITIONS = {
+    State.IDLE: {
+        Event.TRIGGER: State.PREPARING,
+        Event.CANCEL: State.IDLE,
+    },
+    State.PREPARING: {
+        Event.TRIGGER: State.IN_USE,
+        Event.TIMEOUT: State.READY,
+        Event.PREPARED: State.READY,
+        Event.NOT_PREPARED: State.PREPARING,
+        Event.CANCEL: State.IDLE,
+    },
+    State.READY: {
+        Event.TRIGGER: State.IN_USE,
+        Event.TIMEOUT: State.IN_USE,
+        Event.PREPARED: State.READY,
+        Event.NOT_PREPARED: State.PREPARING,
+        Event.CANCEL: State.IDLE,
+    },
+    State.IN_USE: {
+        Event.TRIGGER: State.IDLE,
+        Event.TIMEOUT: State.GET_OUT,
+        Event.CANCEL: State.IDLE,
+    },
+    State.GET_OUT: {
+        Event.TRIGGER: State.IDLE,
+        Event.TIMEOUT: State.IDLE,
+        Event.CANCEL: State.IDLE,
+    },
+}
+
+
+@dataclass(slots=True)
+class ZoneConfig:
+    name: str = option(text)
+    shower_script: str = option(entity_id)
+    trigger_entity: str = option(entity_id)
+    cancel_entity: str = option(entity_id)
+    shower_prepare_state: str = option(entity_id, None)
+    # None = the value of the app
+    shower_prepare_duration: int = option(integer, None)
+    timeout_ready: int = option(integer, None)
+    timeout_in_use: int = option(integer, None)
+    timeout_get_out: int = option(integer, None)
+
+
+@dataclass(slots=True)
+class ShowerConfig(MetricsConfig):
+    debug: bool = option(boolean, False)
+    shower_script: str = option(entity_id, None)
+    shower_prepare_duration: int = option(integer, None)  # Minutes
+    shower_prepare_state: str = option(entity_id, None)
+    timeout_ready: int = option(integer, 20)  # Minutes, -1 = no timeout
+    timeout_in_use: int = option(integer, 10)
+    timeout_get_out: int = option(integer, 5)
+    trigger_entity: str = option(entity_id, None)
+    cancel_entity: str = option(entity_id, None)
+    zones: list = option(Items(ZoneConfig), None)
+    persistence_file: str = option(text, None)
+
+    def check(self):
+        errors = []
+        if not self.zones:
+            for name in ('shower_script', 'trigger_entity', 'cancel_entity'):
+                if getattr(self, name) is None:
+                    errors.append("{}: missing (needed without 'zones')".format(name))
+        else:
+            names = [zone.name for zone in self.zones]
+            for name in sorted(set(name for name in names if names.count(name) > 1)):
+                errors.append("zones: the name {} is used more than once".format(name))
+        return errors
+
+
+class Zone:
+    """
+    One shower (bathroom) with its own state machine. All zones of an app share its listeners and its timer.
+    """
+    def __init__(self, ad, name, shower_script, trigger_entity, cancel_entity, shower_prepare_state=None,
+                 shower_prepare_duration=None, timeout_ready=None, timeout_in_use=None, timeout_get_out=None):
+        self.name = name
+        self.shower_script = ad.get_entity(shower_script)
+        self.trigger_entity = trigger_entity
+        self.cancel_entity = cancel_entity
+        self.shower_prepare_state = ad.get_entity(shower_prepare_state) if shower_prepare_state else None
+
+        # Seconds
+        self.shower_prepare_duration = shower_prepare_duration * 60 if shower_prepare_duration is not None else None
+        self.timeout_ready = timeout_ready * 60
+        self.timeout_in_use = timeout_in_use * 60
+        self.timeout_get_out = timeout_get_out * 60
+
+        self.current_state = State.IDLE
+        self.timeout_deadline = None
+        self.script_state = None  # State the script has last been called with
+        self.script_handle = None  # Pending call of the script
+
+    def timeout(self, state):
+        """
+        :return: seconds until the state proceeds automatically, None for no timeout
+        """
+        match state:
+            case State.PREPARING:
+                return self.shower_prepare_duration
+            case State.READY:
+                return self.timeout_ready
+            case State.IN_USE:
+                return self.timeout_in_use
+            case State.GET_OUT:
+                return self.timeout_get_out
+        return None
+
+
+class ShowerController(InstrumentedApp, hass.Hass):
     """
     Preheat the water, show the state of the heated water by the color of the light and when showering applying some cool effects to the light.
     Only with a few presses on a button.
@@ -28,166 +154,284 @@ class ShowerController(hass.Hass):
     - After you're done showering, press the button again. This will set the light to the default mode and turns
       off the water heater.
     - A long press cancels everything - Light will go into default mode and water heater will turn off.
+
+    Multiple showers: with the 'zones' list one app controls any number of showers (e.g. all bathrooms of a hotel).
+    Every zone has its own state machine, but all zones share one listener per entity and one timer for the
+    timeouts of all zones.
     """
 
     def initialize(self):
         self.log("Initializing ShowerController..")
         # Init arguments
-        self.debug = bool(self.args['debug']) if 'debug' in self.args else False
-
-        self.shower_script = self.get_entity(self.args['shower_script'])
-        self.shower_prepare_duration = int(self.args['shower_prepare_duration']) * 60 if 'shower_prepare_duration' in self.args else None
-        self.shower_prepare_state = self.get_entity(self.args['shower_prepare_state']) if 'shower_prepare_state' in self.args else None
-
-        self.timeout_ready = (int(self.args['timeout_ready']) if 'timeout_ready' in self.args else 20) * 60
-        self.timeout_in_use = (int(self.args['timeout_in_use']) if 'timeout_in_use' in self.args else 10) * 60
-        self.timeout_get_out = (int(self.args['timeout_get_out']) if 'timeout_get_out' in self.args else 5) * 60
-
-        self.trigger_entity = self.get_entity(self.args['trigger_entity'])
-        self.cancel_entity = self.get_entity(self.args['cancel_entity'])
-
-        # Init vars
-        self.current_state = State.IDLE
-        self.timeout_count = -1
+        self.config = config = load_config(self, ShowerConfig)
+        self.metrics = create_metrics(self, config)
+        self.debug = config.debug
+
+        self.zones = self.create_zones()
+
+        # Listeners: entity -> [(zone, event)], so every entity is only subscribed once
+        self.listeners = {}
+        for zone in self.zones.values():
+            self.listeners.setdefault(zone.trigger_entity, []).append((zone, 'trigger'))
+            self.listeners.setdefault(zone.cancel_entity, []).append((zone, 'cancel'))
+            if zone.shower_prepare_state is not None:
+                self.listeners.setdefault(zone.shower_prepare_state.entity_id, []).append((zone, 'prepare_state'))
+
+        # Timeouts of all zones: heap of (deadline, zone name) and one timer for the earliest deadline.
+        # Cancelled timeouts stay in the heap until they come up, they no longer match the deadline of the zone.
+        self.timeouts = []
+        self.timer_handle = None
+        self.timer_deadline = None
+
+        # Restore the state from before the last restart
+        self.store = StateStore(config.persistence_file, self.name) if config.persistence_file else None
+        if self.store is not None:
+            self.restore_state()
 
         # Triggers
-        self.trigger_entity.listen_state(self.trigger_script)
-        self.cancel_entity.listen_state(self.cancel_script)
-        if self.shower_prepare_state is not None:
-            self.shower_prepare_state.listen_state(self.shower_prepare_state_update)
+        for entity in self.listeners:
+            self.listen_state(self.entity_changed, entity)
 
-        # Timer (executes timer_run every second to count down)
-        self.run_every(self.timer_run, start="now", interval=1)
+        self.log("ShowerController initialized with {} zone(s)!".format(len(self.zones)))
 
-        self.log("ShowerController initialized!")
+    def create_zones(self):
+        """
+        Creates the zones from the 'zones' list. Without it, the top level arguments describe a single zone.
+        """
+        config = self.config
+        raw_zones = config.zones or [ZoneConfig(
+            name='shower',
+            shower_script=config.shower_script,
+            trigger_entity=config.trigger_entity,
+            cancel_entity=config.cancel_entity,
+            shower_prepare_state=config.shower_prepare_state,
+        )]
+
+        zones = {}
+        for raw_zone in raw_zones:
+            zones[raw_zone.name] = Zone(
+                ad=self,
+                name=raw_zone.name,
+                shower_script=raw_zone.shower_script,
+                trigger_entity=raw_zone.trigger_entity,
+                cancel_entity=raw_zone.cancel_entity,
+                shower_prepare_state=raw_zone.shower_prepare_state,
+                shower_prepare_duration=raw_zone.shower_prepare_duration
+                if raw_zone.shower_prepare_duration is not None else config.shower_prepare_duration,
+                timeout_ready=raw_zone.timeout_ready if raw_zone.timeout_ready is not None else config.timeout_ready,
+                timeout_in_use=raw_zone.timeout_in_use if raw_zone.timeout_in_use is not None else config.timeout_in_use,
+                timeout_get_out=raw_zone.timeout_get_out
+                if raw_zone.timeout_get_out is not None else config.timeout_get_out,
+            )
+        return zones
+
+    def terminate(self):
+        if self.store is not None:
+            self.store.close()
+        self.metrics.close()
 
-    def clog(self, msg):
-        if self.debug:
-            self.log(msg)
+    """
+    Persistence
+    """
+    def save_state(self):
+        if self.store is None:
+            return
 
-    def trigger_script(self, entity, attribute, old, new, kwargs):
-        self.clog("Script triggered by trigger_entity. Proceed to next state (with logic).")
-        self.set_state()  # Go to next state
-        self.shower_prepare_state_update()
+        self.store.save({'zones': {
+            zone.name: {'state': zone.current_state.name, 'timeout_deadline': zone.timeout_deadline}
+            for zone in self.zones.values()
+        }})
 
-    def cancel_script(self, entity, attribute, old, new, kwargs):
-        self.clog("Script cancelled by cancel_entity. Script will return to idle mode.")
-        self.set_state(state=State.IDLE)
+    def restore_state(self):
+        data, saved_at = self.store.load()
+        if data is None:
+            return
+
+        # Saved before there were zones: the state of the single zone
+        saved_zones = data.get('zones')
+        if saved_zones is None and len(self.zones) == 1:
+            saved_zones = {next(iter(self.zones)): data}
+
+        for name, saved in (saved_zones or {}).items():
+            zone = self.zones.get(name)
+            if zone is None:
+                continue
+
+            zone.current_state = State[saved['state']]
+            zone.script_state = zone.current_state  # The script has already been called before the restart
+            # The deadline is absolute, so the time AppDaemon was not running is already taken into account
+            zone.timeout_deadline = saved['timeout_deadline']
+            if zone.timeout_deadline is not None:
+                heapq.heappush(self.timeouts, (zone.timeout_deadline, zone.name))
+
+            self.log(f"Restored state {zone.current_state} of {zone.name} (remaining timeout: "
+                     f"{self.get_timeout_remaining(zone)}s).")
+
+        self.schedule_timer()
+
+    def entity_changed(self, entity, attribute, old, new, kwargs):
+        for zone, event in self.listeners.get(entity, ()):
+            match event:
+                case 'trigger':
+                    self.trigger_script(zone)
+                case 'cancel':
+                    self.cancel_script(zone)
+                case 'prepare_state':
+                    self.shower_prepare_state_update(zone)
+
+    def trigger_script(self, zone):
+        self.clog("%s: Script triggered by trigger_entity. Proceed to next state.", zone.name)
+        self.handle_event(zone, Event.TRIGGER)
+        self.shower_prepare_state_update(zone)
+
+    def cancel_script(self, zone):
+        self.clog("%s: Script cancelled by cancel_entity. Script will return to idle mode.", zone.name)
+        # Also when already idle, e.g. to turn off a heater that has been turned on by hand
+        self.handle_event(zone, Event.CANCEL, force=True)
 
     """
     State handling
     """
-    def set_state(self, state=None, ignore_logic=False):
+    def handle_event(self, zone, event, force=False):
         """
-        :param state: optional -> automatically go to next state
-        :param ignore_logic: optional -> only relevant when state is None, increases state += 1 and does not set new state based on current state
-        :return:
-
-        Sets a new shower state, either automatically or applies the wanted state from the state parameter.
+        Applies the transition of the event to the zone. Re-entering the current state (e.g. the prepare state
+        reports 'not prepared' again) keeps the timeout and does not call the script again, unless 'force' is set.
         """
+        state = TRANSITIONS[zone.current_state].get(event)
+        if state is None:
+            self.clog("%s: %s is ignored in state %s.", zone.name, event, zone.current_state)
+            return
 
-        # For some reason "state" is not "None" if undefined as it should be but "False".
-        # Does someone know from where the "False" comes? Clearly it is defined to be "None" if the param isn't passed.
-        if state is False:
-            state = None
+        if state == zone.current_state and not force:
+            self.metrics.inc('state_reentries_skipped')
+            return
 
-        if state is None:
-            # If executed without logic, go to the next step...
-            if ignore_logic:
-                match self.current_state:
-                    case State.IDLE:
-                        self.current_state = State.PREPARING
-                    case State.PREPARING:
-                        self.current_state = State.READY
-                    case State.READY:
-                        self.current_state = State.IN_USE
-                    case State.IN_USE:
-                        self.current_state = State.GET_OUT
-                    case State.GET_OUT:
-                        self.current_state = State.IDLE
-
-            # ...otherwise skip some steps and apply a bit of logic
-            else:
-                # IDLE -> PREPARING
-                if self.current_state == State.IDLE:
-                    self.current_state = State.PREPARING
-
-                # PREPARING or READY -> IN_USE
-                elif self.current_state in (State.PREPARING, State.READY):
-                    self.current_state = State.IN_USE
-
-                # IN_USE or GET_OUT -> IDLE
-                elif self.current_state in (State.IN_USE, State.GET_OUT):
-                    self.current_state = State.IDLE
-
-                else:
-                    self.log(f"Error: Unknown state: {self.current_state}")
-        else:
-            self.current_state = state
+        if force:
+            zone.script_state = None
+        self.set_state(zone, state)
 
-        self.clog(f"State has been changed to {self.current_state}")
-        self.execute_actions()
+    def set_state(self, zone, state):
+        """
+        Sets the new shower state of the zone and executes its actions.
+        """
+        zone.current_state = state
+        self.metrics.inc('state_changes')
+        self.clog("%s: State has been changed to %s", zone.name, zone.current_state)
+        self.execute_actions(zone)
 
     # Execute action based on state
-    def execute_actions(self):
-        self.clog(f"Executing actions. Current state is: {self.current_state}")
+    def execute_actions(self, zone):
+        self.clog("%s: Executing actions. Current state is: %s", zone.name, zone.current_state)
 
-        self.cancel_timeout()
+        self.cancel_timeout(zone)
+        self.call_script(zone, zone.current_state)
+        self.set_timeout(zone, zone.timeout(zone.current_state))
 
-        match self.current_state:
-            case State.IDLE:
-                self.shower_script.turn_on(variables={'state': 'idle'})
+        self.schedule_timer()
+        self.save_state()
 
-            case State.PREPARING:
-                self.shower_script.turn_on(variables={'state': 'preparing'})
-                self.set_timeout(self.shower_prepare_duration)
-
-            case State.READY:
-                self.shower_script.turn_on(variables={'state': 'ready'})
-                self.set_timeout(self.timeout_ready)
+    def call_script(self, zone, state):
+        """
+        Calls the script in the background, so the callback does not wait for Home Assistant. A call that has not
+        been sent yet is replaced by the newer one, so only the last state of a burst of changes is sent.
+        """
+        if zone.script_handle is not None:
+            self.cancel_timer(zone.script_handle)
+            zone.script_handle = None
+            self.metrics.inc('script_calls_superseded')
+
+        # The script already runs with this state (e.g. the superseded call would have left it)
+        if state == zone.script_state:
+            self.metrics.inc('script_calls_skipped')
+            return
 
-            case State.IN_USE:
-                self.shower_script.turn_on(variables={'state': 'in_use'})
-                self.set_timeout(self.timeout_in_use)
+        zone.script_handle = self.run_in(self.run_script, 0, zone=zone.name, state=state.name)
 
-            case State.GET_OUT:
-                self.shower_script.turn_on(variables={'state': 'get_out'})
-                self.set_timeout(self.timeout_get_out)
+    def run_script(self, kwargs):
+        zone = self.zones[kwargs['zone']]
+        zone.script_handle = None
+        zone.script_state = State[kwargs['state']]
+        self.metrics.inc('script_calls')
+        zone.shower_script.turn_on(variables={'state': zone.script_state.name.lower()})
 
     """
     Timers & Timeout
     """
-    def set_timeout(self, seconds):
+    def set_timeout(self, zone, seconds):
         if seconds is None:
             return
 
-        if self.timeout_count != -1:
-            self.log("Error: Cannot set new timeout because a timer is already running!")
+        if zone.timeout_deadline is not None:
+            self.log(f"Error: Cannot set new timeout for {zone.name} because a timer is already running!")
             return
 
         if seconds < 1:
-            self.log(f"Timeout for state {self.current_state} is below 1. Ignoring timeout (state will not proceed automatically).")
-
-        self.timeout_count = seconds
-        self.clog(f"Timeout for current action in state {self.current_state} set to {int(seconds / 60)}min.")
-
-    def cancel_timeout(self):
-        if self.timeout_count != -1:
-            self.timeout_count = -1
-            self.clog("Timeout has been cancelled.")
-
-    def timer_run(self, kwargs=None):
-        if self.timeout_count > 0:
-            self.timeout_count -= 1
-
-        if self.timeout_count == 0:
-            self.timeout_count = -1
-            self.clog("Timeout reached! Proceeding to next step...")
-            self.set_state(ignore_logic=True)
-
-    def shower_prepare_state_update(self, entity=None, attribute=None, old=None, new=None, kwargs=None):
-        if self.current_state in (State.PREPARING, State.READY):
-            if self.shower_prepare_state.get_state() == "on":
-                self.set_state(state=State.READY)
-            else:
-                self.set_state(state=State.PREPARING)
+            self.log(f"Timeout for state {zone.current_state} is below 1. Ignoring timeout (state will not proceed automatically).")
+            return
+
+        zone.timeout_deadline = self.get_now_ts() + seconds
+        heapq.heappush(self.timeouts, (zone.timeout_deadline, zone.name))
+        self.clog("%s: Timeout for current action in state %s set to %smin.", zone.name, zone.current_state, int(seconds / 60))
+
+    def cancel_timeout(self, zone):
+        # The entry in the heap is skipped when it comes up
+        if zone.timeout_deadline is not None:
+            zone.timeout_deadline = None
+            self.clog("%s: Timeout has been cancelled.", zone.name)
+
+    def get_timeout_remaining(self, zone):
+        """
+        :return: seconds until the current timeout of the zone is reached or None if no timeout is running
+        """
+        if zone.timeout_deadline is None:
+            return None
+
+        return max(0.0, zone.timeout_deadline - self.get_now_ts())
+
+    def schedule_timer(self):
+        """
+        Runs the timer for the earliest deadline of all zones. It is only restarted if that deadline has changed.
+        """
+        while self.timeouts and self.zones[self.timeouts[0][1]].timeout_deadline != self.timeouts[0][0]:
+            heapq.heappop(self.timeouts)
+
+        deadline = self.timeouts[0][0] if self.timeouts else None
+        self.metrics.set('pending_timeouts', len(self.timeouts))
+        if deadline == self.timer_deadline:
+            return
+
+        if self.timer_handle is not None:
+            self.cancel_timer(self.timer_handle)
+            self.timer_handle = None
+        self.timer_deadline = deadline
+        if deadline is not None:
+            self.timer_handle = self.run_in(self.timeout_reached, max(0.0, deadline - self.get_now_ts()))
+
+    def timeout_reached(self, kwargs=None):
+        self.timer_handle = None
+        self.timer_deadline = None
+
+        # The timeouts are bound to their deadlines, not to the scheduler. If the callback came too early
+        # (e.g. because the clock has been adjusted), schedule_timer waits for the rest of the time.
+        now = self.get_now_ts()
+        due = []
+        while self.timeouts and self.timeouts[0][0] - now < 1:
+            deadline, name = heapq.heappop(self.timeouts)
+            zone = self.zones[name]
+            if zone.timeout_deadline == deadline:
+                zone.timeout_deadline = None
+                due.append(zone)
+
+        for zone in due:
+            self.clog("%s: Timeout reached! Proceeding to next step...", zone.name)
+            self.handle_event(zone, Event.TIMEOUT)
+
+        self.schedule_timer()
+
+    def shower_prepare_state_update(self, zone):
+        if zone.shower_prepare_state is None:
+            return
+
+        if Event.PREPARED in TRANSITIONS[zone.current_state]:
+            prepared = zone.shower_prepare_state.get_state() == "on"
+            self.handle_event(zone, Event.PREPARED if prepared else Event.NOT_PREPARED)
@@ -1,6 +1,20 @@
 import hassapi as hass
+import csv
+import json
+import os
+import threading
+import time as monotonic_time
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from dataclasses import dataclass
 from datetime import datetime, time
+from Config import ConfigError, Items, boolean, entity_id, integer, load_config, number, one_of, option, text, time_of_day
+from Metrics import InstrumentedApp, MetricsConfig, create_metrics
+from SensorHub import parse_number, parse_timestamp
+from StateStore import StateStore
 
 
 class ExcessState(Enum):
@@ -9,6 +23,66 @@ class ExcessState(Enum):
     POSITIVE_EXCESS = 2
 
 
+class ExcessStateHysteresis:
+    """
+    Debounces the excess state by time instead of by ticks. The timer counts the seconds the measured state
+    equals the settled state (up to 'settle_time') and counts down while it differs. The settled state only
+    changes when the timer has run down to 0, so short spikes are ignored. Because the elapsed time is used,
+    late ticks or a changed update interval do not change how long it takes to settle.
+    """
+    def __init__(self, settle_time):
+        self.settle_time = settle_time
+        self.state = ExcessState.NONE
+        self.timer = 0.0
+        self.last_update = None
+
+    @property
+    def settled(self):
+        return self.timer >= self.settle_time
+
+    def update(self, timestamp, state):
+        """
+        :return: the settled excess state
+        """
+        # A clock that went backwards does not count as elapsed time
+        elapsed = 0.0 if self.last_update is None else max(0.0, timestamp - self.last_update)
+        self.last_update = timestamp
+
+        if state == self.state:
+            self.timer = min(self.settle_time, self.timer + elapsed)
+        else:
+            self.timer = max(0.0, self.timer - elapsed)
+
+        if self.timer == 0:
+            self.state = state
+        return self.state
+
+
+class ExcessEstimator:
+    """
+    Rolling window of the excess power samples of the last 'window' seconds. The estimate is a percentile
+    of the window (the median by default), so single outliers (e.g. a kettle or a passing cloud) do not
+    switch any devices. A window of 0 returns the current sample.
+    """
+    def __init__(self, window, percentile=50):
+        self.window = window
+        self.percentile = percentile
+        self.samples = deque()
+
+    def add(self, timestamp, excess_power):
+        """
+        :return: the estimated excess power
+        """
+        self.samples.append((timestamp, excess_power))
+        while self.samples[0][0] < timestamp - self.window:
+            self.samples.popleft()
+
+        if len(self.samples) == 1:
+            return excess_power
+        values = sorted(value for _, value in self.samples)
+        return values[round(self.percentile / 100 * (len(values) - 1))]
+
+
 class BatteryState:
     def __init__(self, percentage, start, end, min_charge_power):
         self.percentage = percentage
@@ -16,52 +90,534 @@ class BatteryState:
         self.end = end
         self.min_charge_power = min_charge_power
 
+    def windows(self):
+        """
+        :return: the time range as list of (start, end) in seconds of the day, end exclusive.
+        The end minute is included, a range that ends before it starts goes over midnight.
+        """
+        start = to_seconds(self.start)
+        end = min(to_seconds(self.end) + 60, 86400)
+        if start < end:
+            return [(start, end)]
+        return [(start, 86400), (0, end)]
 
-class Device:
-    def __init__(self, ad, entity_id, consumption, enabled=False, enabled_by=None, min_cycle_duration=30):
-        self.entity_id = entity_id
-        self.consumption = consumption
-        self.turned_on_by_script = False
-        self.__enabled = enabled
-        self.__enabled_by_id = enabled_by
-        self.__min_cycle_duration = min_cycle_duration
 
+def to_seconds(value):
+    parsed = value if isinstance(value, time) else time.fromisoformat(str(value))
+    return parsed.hour * 3600 + parsed.minute * 60 + parsed.second
+
+
+class BatterySchedule:
+    """
+    Index of the battery states by time of the day. The day is split at every start/end into segments
+    that know their active battery states (in configured order), so a lookup is a binary search.
+    The current segment is cached until its end, so it is only looked up again at a boundary.
+    """
+    def __init__(self, battery_states):
+        boundaries = {0, 86400}
+        for battery_state in battery_states:
+            for start, end in battery_state.windows():
+                boundaries.update((start, end))
+        self.boundaries = sorted(boundaries)
+
+        self.segments = []
+        for start in self.boundaries[:-1]:
+            self.segments.append([
+                battery_state for battery_state in battery_states
+                if any(window_start <= start < window_end for window_start, window_end in battery_state.windows())
+            ])
+
+        self.__active = None
+        self.__valid_from = None
+        self.__valid_until = None
+
+    def active(self, timestamp, seconds_of_day):
+        """
+        :return: the battery states whose time range contains the given time
+        """
+        if self.__valid_until is None or not (self.__valid_from <= timestamp < self.__valid_until):
+            index = bisect_right(self.boundaries, seconds_of_day) - 1
+            self.__active = self.segments[index]
+            self.__valid_from = timestamp - (seconds_of_day - self.boundaries[index])
+            self.__valid_until = timestamp + (self.boundaries[index + 1] - seconds_of_day)
+        return self.__active
+
+
+class SolarForecast:
+    """
+    Hourly solar forecast (W per hour, starting at the given time). The values are summed up once when the
+    forecast changes, so the remaining energy of the day is a binary search instead of a sum per tick.
+    """
+    def __init__(self):
+        self.times = []
+        self.watts = []
+        self.cumulative = [0.0]
+
+    def update(self, values):
+        """
+        :param values: dict of time (ISO string or unix time, also as string) -> W
+        """
+        forecast = sorted(
+            (parse_timestamp(value), float(watts)) for value, watts in values.items()
+        )
+        self.times = [timestamp for timestamp, _ in forecast]
+        self.watts = [watts for _, watts in forecast]
+        self.cumulative = [0.0]
+        for watts in self.watts:
+            self.cumulative.append(self.cumulative[-1] + watts)
+
+    @property
+    def available(self):
+        return len(self.times) > 0
+
+    def energy_until(self, timestamp):
+        """
+        :return: forecasted energy (Wh) from the start of the forecast until the given time
+        """
+        index = bisect_right(self.times, timestamp) - 1
+        if index < 0:
+            return 0.0
+        hour_fraction = min(timestamp - self.times[index], 3600) / 3600
+        return self.cumulative[index] + self.watts[index] * hour_fraction
+
+    def remaining_energy(self, start, end):
+        return max(0.0, self.energy_until(end) - self.energy_until(start))
+
+
+def allocate_greedy(table, indices, excess_power, deadline=None, order=None):
+    """
+    Switches devices on in the configured order as long as there is enough excess power left.
+    A device is only switched on if the excess exceeds its consumption plus its 'on_margin' and it is only
+    switched off if the excess drops below its consumption minus its 'off_margin' (see DeviceTable.threshold).
+    Locked devices keep their current state but are still reported as wanted on/off.
+
+    @returns a list with the wanted state (True = on) of every device in indices
+    """
+    consumption, threshold, powered_on, locked = table.consumption, table.threshold, table.powered_on, table.locked
+    wanted = [False] * len(indices)
+    for n in (order if order is not None else range(len(indices))):
+        i = indices[n]
+        wanted[n] = threshold[i] < excess_power
+        if (powered_on[i] if locked[i] else wanted[n]):
+            excess_power -= consumption[i]
+    return wanted
+
+
+def allocate_priority(table, indices, excess_power, deadline=None):
+    """
+    Same as greedy, but devices with a higher 'priority' get the excess power first.
+    Devices with the same priority keep their configured order.
+    """
+    order = sorted(range(len(indices)), key=lambda n: -table.priority[indices[n]])
+    return allocate_greedy(table, indices, excess_power, order=order)
+
+
+def allocate_optimal(table, indices, excess_power, deadline=None, resolution=10):
+    """
+    Picks the set of devices that uses as much of the excess power as possible (0/1 knapsack).
+    The weight of a device is its switching threshold (consumption and on/off margin), rounded up
+    to 'resolution' watts to keep the table small. Between equally good
+    sets the one that keeps more devices in their current state is chosen (less toggling).
+    Falls back to greedy if the deadline (time.monotonic()) is exceeded.
+    """
+    consumption, threshold, powered_on, locked = table.consumption, table.threshold, table.powered_on, table.locked
+    wanted = [bool(powered_on[i]) for i in indices]
+    free = [n for n, i in enumerate(indices) if not locked[i]]
+
+    # Locked devices that stay on use their power in any case
+    capacity = excess_power - 1 - sum(consumption[i] for i in indices if locked[i] and powered_on[i])
+    if capacity < 0 or not free:
+        for n in free:
+            wanted[n] = False
+        return wanted
+
+    slots = int(capacity // resolution)
+    weights = [max(0, int(-(-threshold[indices[n]] // resolution))) for n in free]
+    # Prefer the used power, then the number of devices that do not have to be toggled
+    values = [weight * (len(free) + 1) + (1 if powered_on[indices[n]] else 0) for weight, n in zip(weights, free)]
+
+    best = [0] * (slots + 1)
+    taken = []
+    for k in range(len(free)):
+        if deadline is not None and monotonic_time.monotonic() > deadline:
+            return allocate_greedy(table, indices, excess_power)
+
+        weight, value = weights[k], values[k]
+        row = bytearray(slots + 1)
+        for c in range(slots, weight - 1, -1):
+            if best[c - weight] + value > best[c]:
+                best[c] = best[c - weight] + value
+                row[c] = 1
+        taken.append(row)
+
+    c = slots
+    for k in range(len(free) - 1, -1, -1):
+        wanted[free[k]] = bool(taken[k][c])
+        if wanted[free[k]]:
+            c -= weights[k]
+    return wanted
+
+
+ALLOCATION_STRATEGIES = {
+    'greedy': allocate_greedy,
+    'priority': allocate_priority,
+    'optimal': allocate_optimal,
+}
+
+
+class StateSnapshot:
+    """
+    Frozen view of the states of all entities needed for one tick.
+    Every entity is only read once per tick and all decisions of that tick see the same state.
+    """
+    def __init__(self, states, timestamp):
+        self.__states = states
+        self.timestamp = timestamp
+
+    def get(self, entity_id, attribute=None):
+        state = self.__states.get(entity_id)
+        if state is None:
+            return None
+        if attribute is None:
+            return state.get('state')
+        if attribute in state:
+            return state[attribute]
+        return state.get('attributes', {}).get(attribute)
+
+
+class DeviceTable:
+    """
+    Column storage of all devices. The states of all devices are read from the snapshot in one pass per tick
+    and the decisions are made on the columns, without method calls per device.
+    """
+    # Measurements needed before the learned consumption replaces the configured one
+    MIN_SAMPLES = 3
+
+    def __init__(self):
+        # Configuration
+        self.entity_ids = []
+        self.enabled_by_ids = []
+        self.power_sensor_ids = []
+        self.consumption = array('l')  # Configured or learned consumption, used for the allocation
+        self.priority = array('l')
+        self.min_cycle_duration = array('d')
+        self.on_margin = array('l')
+        self.off_margin = array('l')
+        self.enabled = array('b')
+        self.turned_on_by_script = array('b')
+
+        # State, updated every tick
+        self.active = array('b')  # Enabled (by config and 'enabled_by')
+        self.powered_on = array('b')
+        self.powered_off = array('b')
+        self.locked = array('b')  # Cannot be toggled yet because of 'min_cycle_duration'
+        self.threshold = array('l')  # Excess power needed to switch on / to stay on
+
+        # Learned consumption (exponentially decaying mean and variance of the 'power_sensor' while on)
+        self.measured_mean = array('d')
+        self.measured_var = array('d')
+        self.measured_count = array('l')
+        self.last_changed = []
+        self.last_changed_ts = array('d')
+
+    def __len__(self):
+        return len(self.entity_ids)
+
+    def add(self, entity_id, consumption, enabled, enabled_by, min_cycle_duration, priority, on_margin=0, off_margin=0,
+            power_sensor=None):
+        self.entity_ids.append(entity_id)
+        self.enabled_by_ids.append(enabled_by)
+        self.power_sensor_ids.append(power_sensor)
+        self.consumption.append(consumption)
+        self.priority.append(priority)
+        self.min_cycle_duration.append(min_cycle_duration)
+        self.on_margin.append(on_margin)
+        self.off_margin.append(off_margin)
+        self.enabled.append(enabled)
+        self.turned_on_by_script.append(False)
+        self.last_changed.append(None)
+        self.last_changed_ts.append(0.0)
+        self.measured_mean.append(0.0)
+        self.measured_var.append(0.0)
+        self.measured_count.append(0)
+        return len(self.entity_ids) - 1
+
+    def update(self, snapshot, convert_utc):
+        """
+        Reads the state of all devices from the snapshot.
+        last_changed is only parsed again if it has changed since the last tick.
+        """
+        now = snapshot.timestamp
+        states = [snapshot.get(entity_id) for entity_id in self.entity_ids]
+        last_changed = [snapshot.get(entity_id, attribute="last_changed") for entity_id in self.entity_ids]
+        for i, value in enumerate(last_changed):
+            if value != self.last_changed[i]:
+                self.last_changed[i] = value
+                self.last_changed_ts[i] = convert_utc(value).timestamp() if value else 0.0
+
+        self.active = array('b', [
+            enabled and (enabled_by is None or snapshot.get(enabled_by) == 'on')
+            for enabled, enabled_by in zip(self.enabled, self.enabled_by_ids)
+        ])
+        self.powered_on = array('b', [state == 'on' for state in states])
+        self.powered_off = array('b', [state == 'off' for state in states])
+        self.locked = array('b', [
+            int(now - changed) <= min_cycle for changed, min_cycle in zip(self.last_changed_ts, self.min_cycle_duration)
+        ])
+
+    def update_thresholds(self):
+        """
+        Devices that are on only need their consumption minus the off margin to stay on,
+        devices that are off need their consumption plus the on margin to be switched on.
+        """
+        self.threshold = array('l', [
+            consumption - off_margin if powered_on else consumption + on_margin
+            for consumption, on_margin, off_margin, powered_on
+            in zip(self.consumption, self.on_margin, self.off_margin, self.powered_on)
+        ])
+
+    def learn(self, snapshot, rate, delay, std_factor):
+        """
+        Updates the learned consumption of all devices with a 'power_sensor' that are on (and have been on
+        for at least 'delay' seconds, so the sensor has caught up). Every sample moves the mean and the variance
+        by max(1 / samples, rate), i.e. it is the plain mean at first and forgets old samples later on.
+        The consumption used for the allocation is the mean plus 'std_factor' standard deviations.
+        """
+        now = snapshot.timestamp
+        for i, power_sensor in enumerate(self.power_sensor_ids):
+            if power_sensor is None or not self.powered_on[i] or now - self.last_changed_ts[i] < delay:
+                continue
+            try:
+                value = float(snapshot.get(power_sensor))
+            except (TypeError, ValueError):
+                continue
+
+            self.add_sample(i, value, rate)
+            self.apply_learned(i, std_factor)
+
+    def add_sample(self, i, value, rate):
+        count = self.measured_count[i] + 1
+        alpha = max(1 / count, rate)
+        diff = value - self.measured_mean[i]
+        self.measured_mean[i] += alpha * diff
+        self.measured_var[i] = (1 - alpha) * (self.measured_var[i] + alpha * diff * diff)
+        self.measured_count[i] = count
+
+    def apply_learned(self, i, std_factor):
+        if self.measured_count[i] >= self.MIN_SAMPLES:
+            self.consumption[i] = round(self.measured_mean[i] + std_factor * self.measured_var[i] ** 0.5)
+
+    def active_indices(self):
+        return [i for i, active in enumerate(self.active) if active]
+
+    def powered_on_consumption(self):
+        return sum(
+            consumption for consumption, active, powered_on in zip(self.consumption, self.active, self.powered_on)
+            if active and powered_on
+        )
+
+    def decide(self, indices, wanted):
+        """
+        Compares the wanted states with the current states in one pass.
+
+        @returns the indices of the devices to turn on, to turn off, that cannot be toggled because they are locked
+        and the power used by the devices after the toggles
+        """
+        turn_on, turn_off, suppressed = [], [], []
+        used_power = 0
+        for i, turn in zip(indices, wanted):
+            if turn:
+                if self.powered_on[i]:
+                    used_power += self.consumption[i]
+                elif self.locked[i]:
+                    suppressed.append(i)
+                else:
+                    turn_on.append(i)
+                    used_power += self.consumption[i]
+            elif not self.powered_off[i]:
+                if self.locked[i]:
+                    suppressed.append(i)
+                    used_power += self.consumption[i]
+                else:
+                    turn_off.append(i)
+        return turn_on, turn_off, suppressed, used_power
+
+
+class ActuationQueue:
+    """
+    Collects the switch commands of one tick and sends them as one multi-entity service call per domain and action.
+    Only the last command for an entity is kept, and it is dropped if the entity is already in the wanted state.
+    The service calls are sent by a thread pool ('concurrency' calls at once), or directly if concurrency is 0.
+    """
+    def __init__(self, ad, concurrency=4):
+        self.__ad = ad
+        self.__commands = {}
+        self.__executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"{ad.name}-actuation") \
+            if concurrency > 0 else None
+
+    def add(self, entity_id, action, current_state=None):
+        # The last command for an entity wins, it replaces an earlier one of the same tick
+        if current_state == ('on' if action == 'turn_on' else 'off'):
+            self.__commands.pop(entity_id, None)
+            return
+
+        self.__commands[entity_id] = action
+
+    def flush(self):
+        groups = {}
+        for entity_id, action in self.__commands.items():
+            groups.setdefault((entity_id.split('.')[0], action), []).append(entity_id)
+        self.__commands = {}
+
+        for (domain, action), entity_ids in groups.items():
+            self.__ad.metrics.inc('service_calls')
+            if self.__executor is None:
+                self.call(domain, action, entity_ids)
+            else:
+                self.__executor.submit(self.call, domain, action, entity_ids)
+
+    def call(self, domain, action, entity_ids):
+        try:
+            self.__ad.call_service(f"{domain}/{action}", entity_id=entity_ids)
+        except Exception as e:
+            self.__ad.log(f"Could not {action} {', '.join(entity_ids)}: {e}")
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+
+
+class Device:
+    """
+    View on one row of the DeviceTable.
+    """
+    def __init__(self, ad, table, index):
         self.__ad = ad
-        self.__entity = ad.get_entity(self.entity_id)
-        self.__enabled_by = ad.get_entity(self.__enabled_by_id) if self.__enabled_by_id else None
+        self.__table = table
+        self.__index = index
+
+    @property
+    def entity_id(self):
+        return self.__table.entity_ids[self.__index]
+
+    @property
+    def consumption(self):
+        return self.__table.consumption[self.__index]
+
+    @property
+    def priority(self):
+        return self.__table.priority[self.__index]
+
+    @property
+    def power_sensor(self):
+        return self.__table.power_sensor_ids[self.__index]
+
+    @property
+    def turned_on_by_script(self):
+        return bool(self.__table.turned_on_by_script[self.__index])
+
+    @turned_on_by_script.setter
+    def turned_on_by_script(self, value):
+        self.__table.turned_on_by_script[self.__index] = bool(value)
+
+    def entity_ids(self):
+        return [entity_id for entity_id in (self.entity_id, self.__table.enabled_by_ids[self.__index], self.power_sensor)
+                if entity_id]
 
-    def is_wanted_state(self, state="on"):
-        return self.__entity.get_state() == state
+    def current_state(self):
+        if self.__table.powered_on[self.__index]:
+            return 'on'
+        if self.__table.powered_off[self.__index]:
+            return 'off'
+        return None
 
     def turn_on(self):
-        self.__entity.turn_on()
+        self.__ad.actuation.add(self.entity_id, 'turn_on', self.current_state())
         self.turned_on_by_script = True
 
     def turn_off(self):
-        self.__entity.turn_off()
+        self.__ad.actuation.add(self.entity_id, 'turn_off', self.current_state())
         self.turned_on_by_script = False
 
-    def is_enabled(self):
-        if not self.__enabled:
-            return False
 
-        if self.__enabled_by:
-            return self.__enabled_by.get_state() == 'on'
+@dataclass(slots=True)
+class DeviceConfig:
+    entity: str = option(entity_id)
+    consumption: int = option(integer)
+    enabled: bool = option(boolean, True)
+    enabled_by: str = option(entity_id, None)
+    min_cycle_duration: int = option(integer, 30)
+    priority: int = option(integer, 0)
+    on_margin: int = option(integer, None)  # None = device_on_margin
+    off_margin: int = option(integer, None)  # None = device_off_margin
+    power_sensor: str = option(entity_id, None)
 
-        return True
 
-    def passed_min_toggle_interval(self):
-        last_changed_seconds = int(
-            datetime.now().timestamp() -
-            self.__ad.convert_utc(self.__entity.get_state(attribute="last_changed")).timestamp()
-        )
-        return last_changed_seconds > self.__min_cycle_duration
+@dataclass(slots=True)
+class BatteryStateConfig:
+    percentage: int = option(integer)
+    start: time = option(time_of_day, time(0, 0))
+    end: time = option(time_of_day, time(23, 59))
+    min_charge_power: int = option(integer)
+
+
+@dataclass(slots=True)
+class SolarDeviceConfig(MetricsConfig):
+    debug: bool = option(boolean, False)
+    production_sensor: str = option(entity_id)
+    consumption_sensor: str = option(entity_id)
+    battery_percentage_sensor: str = option(entity_id, None)
+    excess_buffer: int = option(integer, 10)
+    enabling_battery_percentage: int = option(integer, 0)
+    enabling_switch: str = option(entity_id, None)
+    sensor_hub: str = option(text, None)
+
+    update_interval: int = option(integer, 10)
+    state_settle_time: int = option(integer, 60)
+    excess_window: float = option(number, 0)
+    excess_percentile: float = option(number, 50)
+    event_driven: bool = option(boolean, False)
+    debounce_time: float = option(number, 1)
+
+    allocation_strategy: str = option(one_of(*ALLOCATION_STRATEGIES), 'greedy')
+    allocation_time_budget: float = option(number, 20)
+    actuation_concurrency: int = option(integer, 4)
+
+    devices: list = option(Items(DeviceConfig))
+    device_on_margin: int = option(integer, 0)
+    device_off_margin: int = option(integer, 0)
+    consumption_learning_rate: float = option(number, 0.05)
+    consumption_learning_delay: float = option(number, 10)
+    consumption_std_factor: float = option(number, 1)
 
-    def is_powered_on(self):
-        return self.__entity.get_state() == 'on'
+    battery_states: list = option(Items(BatteryStateConfig), [])
+    battery_capacity: int = option(integer, None)
+    forecast_target_percentage: int = option(integer, 100)
+    forecast_safety_factor: float = option(number, 1.2)
+    solar_forecast_file: str = option(text, None)
+    solar_forecast_sensor: str = option(entity_id, None)
+    solar_forecast_attribute: str = option(text, 'watts')
 
+    persistence_file: str = option(text, None)
+    persistence_max_age: int = option(integer, 600)
 
-class SolarDeviceController(hass.Hass):
+    def check(self):
+        errors = []
+        if self.update_interval <= 0:
+            errors.append("update_interval: has to be greater than 0")
+        if not 0 <= self.excess_percentile <= 100:
+            errors.append("excess_percentile: has to be between 0 and 100")
+        if not 0 < self.consumption_learning_rate <= 1:
+            errors.append("consumption_learning_rate: has to be greater than 0 and at most 1")
+        if not self.devices:
+            errors.append("devices: at least one device is needed")
+        forecast = self.battery_capacity and (self.solar_forecast_file or self.solar_forecast_sensor)
+        if self.battery_percentage_sensor and not self.battery_states and not forecast:
+            errors.append("battery_states: missing (needed with battery_percentage_sensor and without a solar forecast)")
+        return errors
+
+
+class SolarDeviceController(InstrumentedApp, hass.Hass):
     """
     Controls devices based on solar production.
 
@@ -70,167 +626,437 @@ class SolarDeviceController(hass.Hass):
         self.log("Initializing SolarDeviceController")
 
         # Init global values from params
-        self.debug = bool(self.args[s]) if (s := 'debug') in self.args else False
+        config = load_config(self, SolarDeviceConfig)
+        self.metrics = create_metrics(self, config)
+        self.debug = config.debug
+        self.last_tick_time = None
+
+        self.production_sensor = self.get_entity(config.production_sensor)
+        self.consumption_sensor = self.get_entity(config.consumption_sensor)
+        self.battery_sensor = self.get_entity(config.battery_percentage_sensor) if config.battery_percentage_sensor else None
+        self.excess_buffer = config.excess_buffer
+        self.enabling_battery_percentage = config.enabling_battery_percentage
+        self.enabling_switch = self.get_entity(config.enabling_switch) if config.enabling_switch else None
 
-        self.production_sensor = self.get_entity(self.args['production_sensor'])
-        self.consumption_sensor = self.get_entity(self.args['consumption_sensor'])
-        self.battery_sensor = self.get_entity(self.args[s]) if (s := 'battery_percentage_sensor') in self.args else None
-        self.excess_buffer = int(self.args[s]) if (s := 'excess_buffer') in self.args else 10
-        self.enabling_battery_percentage = int(self.args[s]) if (s := 'enabling_battery_percentage') in self.args else 0
-        self.enabling_switch = self.get_entity(self.args[s]) if (s := 'enabling_switch') in self.args else None
+        # Production, consumption and battery percentage can be read from a shared SensorHub app
+        self.sensor_hub = self.get_app(config.sensor_hub) if config.sensor_hub else None
+        if config.sensor_hub and self.sensor_hub is None:
+            raise ConfigError(self.name, [f"sensor_hub: app {config.sensor_hub} is not running"])
+        self.hub_sensors = []
+        if self.sensor_hub is not None:
+            self.hub_sensors = [self.production_sensor.entity_id, self.consumption_sensor.entity_id]
+            if self.battery_sensor:
+                self.hub_sensors.append(self.battery_sensor.entity_id)
 
         # Init vars
-        update_interval = int(self.args[s]) if (s := 'update_interval') in self.args else 10
-        state_settle_time = int(self.args[s]) if (s := 'state_settle_time') in self.args else 60
+        self.excess_hysteresis = ExcessStateHysteresis(config.state_settle_time)
+        self.excess_estimator = ExcessEstimator(window=config.excess_window, percentile=config.excess_percentile)
+        self.update_interval = config.update_interval
 
-        self.current_excess_state_timer = 0
-        self.last_excess_state = ExcessState.NONE
-        self.max_excess_state_timer = int(state_settle_time / update_interval)
+        # Event-driven mode: only run the loop when one of the inputs changes
+        self.event_driven = config.event_driven
+        self.debounce_time = config.debounce_time
+        self.state_cache = {}
+        self.loop_handle = None
+        self.loop_run_time = None
+        self.loop_lock = threading.Lock()  # The SensorHub calls schedule_loop from its own thread
+        self.retry_pending = False
+
+        # Allocation of the excess power to the devices
+        self.allocate = ALLOCATION_STRATEGIES[config.allocation_strategy]
+        self.allocation_time_budget = config.allocation_time_budget / 1000
+
+        # Switch commands are collected per tick and sent together
+        self.actuation = ActuationQueue(self, config.actuation_concurrency)
 
         # Initialize devices
+        self.device_table = DeviceTable()
         self.devices = []
-        raw_devices = self.args['devices']
-        for device in raw_devices:
-            self.devices.append(
-                Device(
-                    ad=self,
-                    entity_id=device['entity'],
-                    consumption=int(device['consumption']),
-                    enabled=device['enabled'] if 'enabled' in device else True,
-                    enabled_by=device['enabled_by'] if 'enabled_by' in device else None,
-                    min_cycle_duration=int(device['min_cycle_duration']) if 'min_cycle_duration' in device else 30,
-                )
+        for device in config.devices:
+            index = self.device_table.add(
+                entity_id=device.entity,
+                consumption=device.consumption,
+                enabled=device.enabled,
+                enabled_by=device.enabled_by,
+                min_cycle_duration=device.min_cycle_duration,
+                priority=device.priority,
+                on_margin=device.on_margin if device.on_margin is not None else config.device_on_margin,
+                off_margin=device.off_margin if device.off_margin is not None else config.device_off_margin,
+                power_sensor=device.power_sensor,
             )
+            self.devices.append(Device(self, self.device_table, index))
+
+        # Learning of the real consumption of devices with a 'power_sensor'
+        self.consumption_learning_rate = config.consumption_learning_rate
+        self.consumption_learning_delay = config.consumption_learning_delay
+        self.consumption_std_factor = config.consumption_std_factor
+        self.learning = any(self.device_table.power_sensor_ids)
 
         # Initialize battery states
         self.battery_states = []
         if self.battery_sensor:
-            raw_battery_states = self.args['battery_states']
-            for raw_battery_state in raw_battery_states:
+            for battery_state in config.battery_states:
                 self.battery_states.append(
                     BatteryState(
-                        percentage=int(raw_battery_state['percentage']),
-                        start=raw_battery_state['start'] or '00:00',
-                        end=raw_battery_state['end'] or '23:59',
-                        min_charge_power=int(raw_battery_state['min_charge_power'])
+                        percentage=battery_state.percentage,
+                        start=battery_state.start,
+                        end=battery_state.end,
+                        min_charge_power=battery_state.min_charge_power,
                     )
                 )
+        self.battery_schedule = BatterySchedule(self.battery_states)
+
+        # Solar forecast to calculate how much power has to be reserved for the battery
+        self.battery_capacity = config.battery_capacity
+        self.forecast_target_percentage = config.forecast_target_percentage
+        self.forecast_safety_factor = config.forecast_safety_factor
+        self.forecast_file = config.solar_forecast_file
+        self.forecast_file_mtime = None
+        self.forecast_file_checked = None
+        self.forecast = None
+        if self.battery_sensor and self.battery_capacity and (self.forecast_file or config.solar_forecast_sensor):
+            self.forecast = SolarForecast()
+            if self.forecast_file:
+                self.load_forecast_file()
+            else:
+                forecast_sensor = config.solar_forecast_sensor
+                self.forecast_attribute = config.solar_forecast_attribute
+                self.listen_state(self.forecast_sensor_changed, forecast_sensor, attribute=self.forecast_attribute)
+                self.forecast_sensor_changed(new=self.get_state(forecast_sensor, attribute=self.forecast_attribute))
+
+        self.watched_entities = self.watched_entity_ids()
+        # Power sensors are only cached for the learning, their readings are no reason to re-evaluate
+        self.power_sensors = {entity_id for entity_id in self.device_table.power_sensor_ids if entity_id}
+
+        # Restore the state from before the last restart
+        # The timestamp of the saved state is refreshed while the app runs, so a settled excess state is not too old
+        self.store = StateStore(config.persistence_file, self.name, refresh_interval=config.persistence_max_age / 2) \
+            if config.persistence_file else None
+        self.persistence_max_age = config.persistence_max_age
+        if self.store is not None:
+            self.restore_state()
 
         # Start loop
-        self.run_every(self.loop, start=f"now+3", interval=update_interval)
+        if self.event_driven:
+            self.start_event_driven()
+        else:
+            self.run_every(self.loop, start=f"now+3", interval=self.update_interval)
 
         self.log("Initialization done!")
 
-    def clog(self, msg):
-        if self.debug:
-            self.log(msg)
+    def terminate(self):
+        if self.sensor_hub is not None:
+            self.sensor_hub.unsubscribe(self.hub_sensor_changed)
+        self.actuation.close()
+        if self.store is not None:
+            self.store.close()
+        self.metrics.close()
+
+    def save_state(self):
+        if self.store is None:
+            return
+
+        self.store.save({
+            'excess_state': self.excess_hysteresis.state.name,
+            'excess_state_seconds': round(self.excess_hysteresis.timer, 1),
+            'turned_on_by_script': [device.entity_id for device in self.devices if device.turned_on_by_script],
+            # entity_id -> [mean, variance, samples] of the learned consumption
+            'measured_consumption': {
+                device.entity_id: [round(self.device_table.measured_mean[i]), round(self.device_table.measured_var[i]),
+                                   self.device_table.measured_count[i]]
+                for i, device in enumerate(self.devices) if self.device_table.measured_count[i] > 0
+            },
+        })
+
+    def restore_state(self):
+        data, saved_at = self.store.load()
+        if data is None:
+            return
+
+        # Always restore which devices have been turned on by this script, otherwise they would be orphaned
+        for device in self.devices:
+            device.turned_on_by_script = device.entity_id in data['turned_on_by_script']
+
+        # The learned consumption does not get outdated by a restart
+        table = self.device_table
+        measured = data.get('measured_consumption', {})
+        for i, device in enumerate(self.devices):
+            if device.entity_id in measured and device.power_sensor:
+                table.measured_mean[i], table.measured_var[i], table.measured_count[i] = measured[device.entity_id]
+                table.apply_learned(i, self.consumption_std_factor)
+
+        # The excess state is only meaningful if the controller has not been stopped for too long
+        elapsed = datetime.now().timestamp() - saved_at
+        if elapsed <= self.persistence_max_age and 'excess_state_seconds' in data:
+            self.excess_hysteresis.state = ExcessState[data['excess_state']]
+            self.excess_hysteresis.timer = min(data['excess_state_seconds'], self.excess_hysteresis.settle_time)
+
+        self.log(f"Restored state from {int(elapsed)}s ago "
+                 f"(excess state: {self.excess_hysteresis.state}, timer: {self.excess_hysteresis.timer}s).")
+
+    def watched_entity_ids(self):
+        entity_ids = [self.production_sensor.entity_id, self.consumption_sensor.entity_id]
+        if self.battery_sensor:
+            entity_ids.append(self.battery_sensor.entity_id)
+        if self.enabling_switch:
+            entity_ids.append(self.enabling_switch.entity_id)
+        for device in self.devices:
+            entity_ids.extend(device.entity_ids())
+
+        # The sensors of the hub are not read by this app
+        return [entity_id for entity_id in dict.fromkeys(entity_ids) if entity_id not in self.hub_sensors]
+
+    def read_number(self, snapshot, entity_id):
+        """
+        :return: the value of a sensor (from the hub or the snapshot), None if it is unavailable
+        """
+        if entity_id in self.hub_sensors:
+            return self.sensor_hub.value(entity_id)
+        return parse_number(snapshot.get(entity_id))
+
+    def forecast_sensor_changed(self, entity=None, attribute=None, old=None, new=None, kwargs=None):
+        if not isinstance(new, dict):
+            return
+        try:
+            self.forecast.update(new)
+        except (TypeError, ValueError) as e:
+            # The previous forecast is kept
+            self.log(f"Could not read solar forecast from sensor: {e}")
+            return
+        self.clog("Updated solar forecast from sensor (%s values).", len(new))
+
+    def load_forecast_file(self):
+        """
+        Loads the forecast file (JSON object of time -> W or CSV with the columns 'time' and 'watts')
+        if it has been changed. The file is checked at most every 5 minutes.
+        """
+        now = self.get_now_ts()
+        if self.forecast_file_checked is not None and now - self.forecast_file_checked < 300:
+            return
+        self.forecast_file_checked = now
+
+        try:
+            mtime = os.path.getmtime(self.forecast_file)
+            if mtime == self.forecast_file_mtime:
+                return
+
+            with open(self.forecast_file, newline='') as file:
+                if self.forecast_file.endswith('.csv'):
+                    values = {row['time']: row['watts'] for row in csv.DictReader(file)}
+                else:
+                    values = json.load(file)
+            self.forecast.update(values)
+            self.forecast_file_mtime = mtime
+            self.clog("Loaded solar forecast from %s (%s values).", self.forecast_file, len(values))
+        except (OSError, ValueError, KeyError) as e:
+            self.log(f"Could not load solar forecast from {self.forecast_file}: {e}")
+
+    def battery_reservation(self, battery_percentage, production, timestamp):
+        """
+        :return: the power (W) that has to be reserved for charging the battery
+        """
+        now = self.datetime()
+        seconds_of_day = now.hour * 3600 + now.minute * 60 + now.second
+
+        if self.forecast is not None:
+            if self.forecast_file:
+                self.load_forecast_file()
+
+            if self.forecast.available:
+                # Reserve the share of the current production that the battery needs to be full at the end of the day
+                needed_energy = max(0, self.forecast_target_percentage - battery_percentage) / 100 * self.battery_capacity
+                remaining_energy = self.forecast.remaining_energy(timestamp, timestamp + 86400 - seconds_of_day)
+                if needed_energy <= 0:
+                    return 0
+                if remaining_energy <= needed_energy * self.forecast_safety_factor:
+                    return production
+                return int(production * needed_energy * self.forecast_safety_factor / remaining_energy)
+
+        for battery_state in self.battery_schedule.active(timestamp, seconds_of_day):
+            if battery_percentage <= battery_state.percentage:
+                return battery_state.min_charge_power
+        return 0
+
+    def take_snapshot(self):
+        """
+        Reads every entity needed for one tick exactly once. In event-driven mode the states are
+        taken from the local cache that is kept up to date by the state listeners.
+        """
+        if self.event_driven:
+            states = dict(self.state_cache)
+        else:
+            states = {entity_id: self.get_state(entity_id, attribute="all") for entity_id in self.watched_entities}
+
+        return StateSnapshot(states, self.get_now_ts())
+
+    def start_event_driven(self):
+        for entity_id in self.watched_entities:
+            self.state_cache[entity_id] = self.get_state(entity_id, attribute="all")
+            self.listen_state(self.input_changed, entity_id, attribute="all")
+        for entity_id in self.hub_sensors:
+            self.sensor_hub.register(entity_id, self.hub_sensor_changed)
+
+        self.schedule_loop(3)
+
+    def input_changed(self, entity, attribute, old, new, kwargs):
+        self.state_cache[entity] = new
+
+        # Attribute-only updates (e.g. last_updated) are no reason to re-evaluate
+        if old is not None and new is not None and old.get('state') == new.get('state'):
+            return
+        if entity in self.power_sensors:
+            return
+
+        self.schedule_loop(self.debounce_time)
+
+    def hub_sensor_changed(self, entity_id, reading):
+        self.schedule_loop(self.debounce_time)
+
+    def schedule_loop(self, delay):
+        """
+        Schedules a single loop run. Changes arriving while a run is already pending are
+        handled by that run (the cache is read when the loop executes), so a burst of updates
+        costs exactly one evaluation. A pending run that is later than the new one (e.g. the retry
+        after 'update_interval' while the excess state settles) is moved forward.
+        """
+        with self.loop_lock:
+            run_time = self.get_now_ts() + delay
+            if self.loop_handle is not None and self.timer_running(self.loop_handle):
+                if self.loop_run_time <= run_time:
+                    return
+                self.cancel_timer(self.loop_handle)
+
+            self.loop_handle = self.run_in(self.loop, delay)
+            self.loop_run_time = run_time
 
     """
-    The loops needs to be called exactly every second in order to work correctly.
+    Runs one control tick. All timing is based on the timestamps of the ticks, so the loop does not have
+    to be called at an exact interval.
     """
     def loop(self, entity=None, attribute=None, old=None, new=None, kwargs=None):
-        if self.enabling_switch is not None and self.enabling_switch.get_state() == 'off':
+        self.timed_tick(self.control, None if self.event_driven else self.update_interval)
+
+    def control(self):
+        with self.loop_lock:
+            # A run that has been scheduled since this one started stays pending
+            if self.loop_handle is not None and not self.timer_running(self.loop_handle):
+                self.loop_handle = None
+        self.retry_pending = False
+        snapshot = self.take_snapshot()
+
+        self.device_table.update(snapshot, self.convert_utc)
+        if self.learning:
+            self.device_table.learn(snapshot, self.consumption_learning_rate, self.consumption_learning_delay,
+                                    self.consumption_std_factor)
+        self.device_table.update_thresholds()
+
+        if self.enabling_switch is not None and snapshot.get(self.enabling_switch.entity_id) == 'off':
             for device in self.devices:
                 if device.turned_on_by_script:
                     device.turn_off()
+            self.actuation.flush()
             self.clog("Controller is disabled (by 'enabling_switch'). "
                       "All devices that were turned on by this script have been turned off.")
+            self.save_state()
             return
 
-        production = int(self.production_sensor.get_state())
-        consumption = int(self.consumption_sensor.get_state())
+        production = self.read_number(snapshot, self.production_sensor.entity_id)
+        consumption = self.read_number(snapshot, self.consumption_sensor.entity_id)
+        battery_percentage = self.read_number(snapshot, self.battery_sensor.entity_id) if self.battery_sensor else 0
+        if production is None or consumption is None or battery_percentage is None:
+            # Keep the devices as they are until the sensors are back
+            self.metrics.inc('sensor_unavailable')
+            self.clog("Not controlling any devices. A sensor is unavailable.")
+            self.actuation.flush()
+            return
+        production, consumption = int(production), int(consumption)
         excess_power = (production - consumption) + self.excess_buffer
 
         # Set excess to -1 if battery percentage below 'enabling_battery_percentage' (powers off all devices)
         if self.battery_sensor:
-            battery_percentage = int(self.battery_sensor.get_state())
+            battery_percentage = int(battery_percentage)
             if battery_percentage < self.enabling_battery_percentage:
                 excess_power = -1
                 self.clog("Set excess power to -1 because battery is too low (enabling_battery_percentage).")
             else:
-                for battery_state in self.battery_states:
-                    # TODO check time ranges
-                    in_time_range = True
-                    if battery_percentage <= battery_state.percentage and in_time_range:
-                        excess_power -= battery_state.min_charge_power
-                        self.clog(f"Preserving {battery_state.min_charge_power}W excess power for the battery"
-                                  f"(Current percentage: {battery_percentage}).")
-                        break
+                reserved_power = self.battery_reservation(battery_percentage, production, snapshot.timestamp)
+                if reserved_power > 0:
+                    excess_power -= reserved_power
+                    self.clog("Preserving %sW excess power for the battery (Current percentage: %s).",
+                              reserved_power, battery_percentage)
 
         # Add consumption of already powered on devices to access (to prevent toggling on each update)
-        for device in self.devices:
-            if device.is_enabled() and device.is_powered_on():
-                excess_power += device.consumption
+        excess_power += self.device_table.powered_on_consumption()
+
+        # Smooth the excess power over the configured window
+        excess_power = self.excess_estimator.add(snapshot.timestamp, excess_power)
 
         # Initialize last excess state
+        hysteresis = self.excess_hysteresis
         if excess_power > 0:
             excess_state = ExcessState.POSITIVE_EXCESS
         elif excess_power < 0:
             excess_state = ExcessState.NEGATIVE_EXCESS
         else:
-            excess_state = self.last_excess_state
+            excess_state = hysteresis.state
 
-        # Run excess state counter
-        if self.last_excess_state == excess_state:
-            if self.current_excess_state_timer < self.max_excess_state_timer:
-                self.current_excess_state_timer += 1
-        else:
-            if self.current_excess_state_timer > 0:
-                self.current_excess_state_timer -= 1
-
-        # If timer has been finished (is back to 0)
-        if self.current_excess_state_timer == 0:
-            self.last_excess_state = excess_state
+        # Run excess state timer
+        last_excess_state = hysteresis.update(snapshot.timestamp, excess_state)
 
         # Send debug message
         self.clog(
-            f"Excess power: {excess_power}; "
-            f"State timer: {self.current_excess_state_timer}; "
-            f"Current state: {excess_state}; "
-            f"Last state: {self.last_excess_state}"
+            "Excess power: %s; State timer: %ss; Current state: %s; Last state: %s",
+            excess_power, round(hysteresis.timer, 1), excess_state, last_excess_state
         )
 
         # Control devices (if last excess state is equal to current excess state)
-        if self.last_excess_state == excess_state:
-            for device in self.devices:
-                excess_power -= self.control_device(device, excess_power)
+        if last_excess_state == excess_state:
+            excess_power -= self.control_devices(excess_power, snapshot)
 
             # This should nearly match the grid excess power if the battery is full (or if you don't have one).
-            self.clog(f"Excess (controlled devices included): {excess_power}")
+            self.clog("Excess (controlled devices included): %s", excess_power)
         else:
             self.clog("Not controlling any devices. Waiting for last and current excess state to get equal..")
 
+        self.actuation.flush()
+        self.save_state()
+
+        # In event-driven mode keep ticking while the excess state settles or a toggle is postponed,
+        # because there might be no input change that would trigger the next run.
+        if self.event_driven and (self.retry_pending
+                                  or last_excess_state != excess_state
+                                  or not hysteresis.settled):
+            self.schedule_loop(self.update_interval)
+
     """
-    Turns a device on or off based on the excess power.
-    
-    @returns the power usage of the device (0 if powered off)
+    Decides which devices should be powered on with the configured allocation strategy and applies it.
+
+    @returns the power usage of all controlled devices
     """
-    def control_device(self, device, excess_power):
-        if not device.is_enabled():
-            return 0
+    def control_devices(self, excess_power, snapshot):
+        table = self.device_table
+        indices = table.active_indices()
 
-        passed_min_toggle_interval = device.passed_min_toggle_interval()
+        wanted = self.allocate(table, indices, excess_power, deadline=monotonic_time.monotonic() + self.allocation_time_budget)
+        turn_on, turn_off, suppressed, used_power = table.decide(indices, wanted)
 
-        if device.consumption < excess_power:
-            if device.is_wanted_state("on"):
-                return device.consumption
-            else:
-                if passed_min_toggle_interval:
-                    device.turn_on()
-                    self.clog(f"Turned on device {device.entity_id}.")
-                    return device.consumption
-                else:
-                    self.clog(f"Did not turn on device {device.entity_id} because of minimum toggle interval.")
-                    return 0
+        for i in turn_on:
+            self.devices[i].turn_on()
+            self.metrics.inc('device_toggles')
+            self.clog("Turned on device %s.", table.entity_ids[i])
 
-        else:
-            if device.is_wanted_state("off"):
-                return 0
-            else:
-                if passed_min_toggle_interval:
-                    device.turn_off()
-                    self.clog(f"Turned off device {device.entity_id}.")
-                    return 0
-                else:
-                    self.clog(f"Did not turn off device {device.entity_id} because of minimum toggle interval.")
-                    return device.consumption
+        for i in turn_off:
+            self.devices[i].turn_off()
+            self.metrics.inc('device_toggles')
+            self.clog("Turned off device %s.", table.entity_ids[i])
+
+        for i in suppressed:
+            self.metrics.inc('suppressed_toggles')
+            self.clog("Did not turn %s device %s because of minimum toggle interval.",
+                      "off" if table.powered_on[i] else "on", table.entity_ids[i])
+
+        # Locked devices might have to be toggled as soon as their minimum toggle interval has passed
+        if any(table.locked[i] for i in indices):
+            self.retry_pending = True
+
+        return used_power
@@ -0,0 +1,106 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class StateStore:
+    """
+    Small persistence layer for the states of the controllers, so they survive a restart of AppDaemon
+    or a reload of the app.
+    Every app stores one JSON document (identified by its name) in a SQLite file. Saving is done by a
+    background thread and only the newest state is written. Unchanged states are not written at all, but
+    with a 'refresh_interval' (seconds) the thread renews the timestamp of a state saved since the start,
+    so it shows that the state was still current when the app stopped.
+    """
+    def __init__(self, path, name, refresh_interval=None):
+        self.path = path
+        self.name = name
+        self.refresh_interval = refresh_interval
+
+        self.__last_data = None
+        self.__last_saved = None
+        self.__pending = None
+        self.__stopped = False
+        self.__condition = threading.Condition()
+
+        connection = self.__connect()
+        try:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, saved_at REAL, data TEXT)")
+        finally:
+            connection.close()
+
+        self.__thread = threading.Thread(target=self.__run, name=f"StateStore-{name}", daemon=True)
+        self.__thread.start()
+
+    def __connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def load(self):
+        """
+        :return: tuple of the saved state and the timestamp when it has been saved, or (None, None)
+        """
+        connection = self.__connect()
+        try:
+            row = connection.execute("SELECT data, saved_at FROM state WHERE name = ?", (self.name,)).fetchone()
+        finally:
+            connection.close()
+
+        if row is None:
+            return None, None
+
+        self.__last_data = row[0]
+        return json.loads(row[0]), row[1]
+
+    def save(self, state):
+        data = json.dumps(state, sort_keys=True, separators=(',', ':'))
+        with self.__condition:
+            if data == self.__last_data:
+                return
+            self.__last_data = data
+            self.__last_saved = time.time()
+            self.__pending = (data, self.__last_saved)
+            self.__condition.notify()
+
+    def close(self):
+        """
+        Writes the pending state (if any) and stops the background thread.
+        """
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify()
+        self.__thread.join(timeout=10)
+
+    def __run(self):
+        connection = self.__connect()
+        try:
+            while True:
+                with self.__condition:
+                    while self.__pending is None and not self.__stopped:
+                        if self.refresh_interval is None or self.__last_saved is None:
+                            self.__condition.wait()
+                            continue
+
+                        # Write the unchanged state again with a new timestamp
+                        remaining = self.__last_saved + self.refresh_interval - time.time()
+                        if remaining <= 0:
+                            self.__last_saved = time.time()
+                            self.__pending = (self.__last_data, self.__last_saved)
+                        else:
+                            self.__condition.wait(remaining)
+                    pending = self.__pending
+                    self.__pending = None
+                    stopped = self.__stopped
+
+                if pending is not None:
+                    with connection:
+                        connection.execute(
+                            "INSERT OR REPLACE INTO state (name, saved_at, data) VALUES (?, ?, ?)",
+                            (self.name, pending[1], pending[0])
+                        )
+
+                if stopped:
+                    return
+        finally:
+            connection.close()
@@ -0,0 +1,3 @@
+"""
+Offline simulation of the apps without Home Assistant and AppDaemon.
+"""
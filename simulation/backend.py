@@ -0,0 +1,225 @@
+"""
+In-process replacement for the parts of AppDaemon's hass.Hass API that are used by the apps.
+All timers run on a virtual clock, so a simulation runs as fast as the apps can compute.
+"""
+import heapq
+import itertools
+import sys
+import types
+from datetime import datetime, timezone
+
+
+class Entity:
+    def __init__(self, app, entity_id):
+        self.app = app
+        self.entity_id = entity_id
+
+    def get_state(self, attribute=None):
+        return self.app.get_state(self.entity_id, attribute=attribute)
+
+    def set_state(self, state=None, attributes=None):
+        self.app.set_state(self.entity_id, state=state, attributes=attributes)
+
+    def turn_on(self, **kwargs):
+        self.app.turn_on(self.entity_id, **kwargs)
+
+    def turn_off(self, **kwargs):
+        self.app.turn_off(self.entity_id, **kwargs)
+
+    def listen_state(self, callback, **kwargs):
+        return self.app.listen_state(callback, self.entity_id, **kwargs)
+
+
+class Backend:
+    """
+    Holds the entity states, the state listeners and the scheduler of a simulation.
+    """
+    def __init__(self, start_time=0.0):
+        self.now = start_time
+        self.states = {}
+        self.listeners = {}
+        self.timers = []
+        self.handles = itertools.count(1)
+        self.cancelled = set()
+        self.after_callback = None
+        self.apps = {}
+
+        # Statistics
+        self.state_reads = 0
+        self.service_calls = []
+
+    def iso(self, timestamp):
+        return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+    def set_state(self, entity_id, state, attributes=None):
+        old = self.states.get(entity_id)
+        state = None if state is None else str(state)
+        changed = old is None or old['state'] != state
+        new = {
+            'entity_id': entity_id,
+            'state': state,
+            'attributes': dict(attributes if attributes is not None else (old['attributes'] if old else {})),
+            'last_changed': self.iso(self.now) if changed else old['last_changed'],
+            'last_updated': self.iso(self.now),
+            'last_reported': self.iso(self.now),
+        }
+        self.states[entity_id] = new
+
+        for handle, (callback, attribute, kwargs) in list(self.listeners.get(entity_id, {}).items()):
+            if attribute == 'all':
+                self.run_callback(callback, entity_id, attribute, old, new, kwargs)
+            elif changed:
+                self.run_callback(callback, entity_id, attribute, old and old['state'], state, kwargs)
+
+    def run_callback(self, callback, *args):
+        callback(*args)
+        if self.after_callback is not None:
+            self.after_callback()
+
+    def schedule(self, callback, at, interval=None, kwargs=None):
+        handle = next(self.handles)
+        heapq.heappush(self.timers, (at, handle, callback, interval, kwargs or {}))
+        return handle
+
+    def run_until(self, timestamp):
+        """
+        Executes all timers that are due until (including) the given time and advances the clock.
+        """
+        while self.timers and self.timers[0][0] <= timestamp:
+            at, handle, callback, interval, kwargs = heapq.heappop(self.timers)
+            if handle in self.cancelled:
+                self.cancelled.discard(handle)
+                continue
+
+            self.now = max(self.now, at)
+            if interval:
+                heapq.heappush(self.timers, (at + interval, handle, callback, interval, kwargs))
+            self.run_callback(callback, kwargs)
+
+        self.now = max(self.now, timestamp)
+
+
+class Hass:
+    """
+    Replacement for hassapi.Hass. The backend and the app arguments have to be passed to the constructor,
+    the simulation calls initialize() itself.
+    """
+    def __init__(self, backend, name, args):
+        self.backend = backend
+        self.name = name
+        self.args = args
+        self.logs = []
+        backend.apps[name] = self
+
+    def log(self, msg, *args, level="INFO", **kwargs):
+        self.logs.append((self.backend.now, level, msg % args if args else msg))
+
+    def error(self, msg, *args, **kwargs):
+        self.log(msg, *args, level="ERROR")
+
+    def get_app(self, name):
+        return self.backend.apps.get(name)
+
+    # States
+    def get_entity(self, entity_id):
+        return Entity(self, entity_id)
+
+    def entity_exists(self, entity_id):
+        return entity_id in self.backend.states
+
+    def get_state(self, entity_id=None, attribute=None, default=None, **kwargs):
+        self.backend.state_reads += 1
+        if entity_id is None:
+            return dict(self.backend.states)
+
+        state = self.backend.states.get(entity_id)
+        if state is None:
+            return default
+        if attribute is None:
+            return state['state']
+        if attribute == 'all':
+            return state
+        if attribute in state:
+            return state[attribute]
+        return state['attributes'].get(attribute, default)
+
+    def set_state(self, entity_id, state=None, attributes=None, **kwargs):
+        current = self.backend.states.get(entity_id)
+        if state is None and current is not None:
+            state = current['state']
+        self.backend.set_state(entity_id, state, attributes)
+
+    def listen_state(self, callback, entity_id=None, attribute=None, **kwargs):
+        handle = next(self.backend.handles)
+        entity_ids = entity_id if isinstance(entity_id, list) else [entity_id]
+        for entity_id in entity_ids:
+            self.backend.listeners.setdefault(entity_id, {})[handle] = (callback, attribute, kwargs)
+        return handle
+
+    def cancel_listen_state(self, handle):
+        for listeners in self.backend.listeners.values():
+            listeners.pop(handle, None)
+
+    # Services
+    def call_service(self, service, **kwargs):
+        self.backend.service_calls.append((self.backend.now, service, kwargs))
+
+        domain, action = service.split('/')
+        entity_ids = kwargs.get('entity_id') or []
+        for entity_id in ([entity_ids] if isinstance(entity_ids, str) else entity_ids):
+            if domain in ('script', 'scene', 'input_button'):
+                continue
+            if action == 'turn_on':
+                self.backend.set_state(entity_id, 'on')
+            elif action == 'turn_off':
+                self.backend.set_state(entity_id, 'off')
+
+    def turn_on(self, entity_id, **kwargs):
+        self.call_service(f"{entity_id.split('.')[0]}/turn_on", entity_id=entity_id, **kwargs)
+
+    def turn_off(self, entity_id, **kwargs):
+        self.call_service(f"{entity_id.split('.')[0]}/turn_off", entity_id=entity_id, **kwargs)
+
+    # Scheduler
+    def get_now_ts(self):
+        return self.backend.now
+
+    def get_now(self):
+        return datetime.fromtimestamp(self.backend.now, timezone.utc)
+
+    def datetime(self, aware=False):
+        now = datetime.fromtimestamp(self.backend.now, timezone.utc)
+        return now if aware else now.astimezone().replace(tzinfo=None)
+
+    def convert_utc(self, utc):
+        return datetime.fromisoformat(utc)
+
+    def parse_start(self, start):
+        if start is None or start == "now":
+            return self.backend.now
+        if isinstance(start, str) and start.startswith("now+"):
+            return self.backend.now + float(start[4:])
+        if isinstance(start, datetime):
+            return start.timestamp()
+        return float(start)
+
+    def run_in(self, callback, delay, **kwargs):
+        return self.backend.schedule(callback, self.backend.now + delay, kwargs=kwargs)
+
+    def run_every(self, callback, start=None, interval=1, **kwargs):
+        return self.backend.schedule(callback, self.parse_start(start), interval=interval, kwargs=kwargs)
+
+    def cancel_timer(self, handle):
+        self.backend.cancelled.add(handle)
+
+    def timer_running(self, handle):
+        return handle not in self.backend.cancelled and any(timer[1] == handle for timer in self.backend.timers)
+
+
+def install():
+    """
+    Registers this module as 'hassapi', so the apps can be imported without AppDaemon.
+    """
+    module = types.ModuleType('hassapi')
+    module.Hass = Hass
+    sys.modules['hassapi'] = module
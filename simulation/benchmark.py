@@ -0,0 +1,252 @@
+"""
+Benchmarks the control loops against the simulation backend.
+
+Usage:
+    python -m simulation.benchmark --output bench.json
+
+Measures per tick: wall time, state reads, service calls and allocated memory of
+SolarDeviceController.loop for 1, 10, 100 and 1000 devices (and as many battery states, including the
+startup time with the config validation) and of
+RestChargeController.loop, plus the end-to-end latency of charge_battery against a local HTTP server.
+"""
+import argparse
+import importlib
+import json
+import platform
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from simulation.backend import Backend, install
+from simulation.replay import APPS_DIR
+
+DEVICE_COUNTS = (1, 10, 100, 1000)
+
+
+def create_app(module_name, args, states):
+    install()
+    if APPS_DIR not in sys.path:
+        sys.path.insert(0, APPS_DIR)
+
+    backend = Backend(start_time=1_700_000_000.0)
+    for entity_id, state in states.items():
+        backend.set_state(entity_id, state)
+
+    module = importlib.import_module(module_name)
+    app = getattr(module, module_name)(backend, module_name, args)
+    app.initialize()
+    return backend, app
+
+
+def summarize(values):
+    values = sorted(values)
+    return {
+        'mean': statistics.fmean(values),
+        'p50': values[len(values) // 2],
+        'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+        'max': values[-1],
+    }
+
+
+def measure_ticks(backend, tick, ticks, interval):
+    """
+    Runs the tick function 'ticks' times (advancing the virtual clock by 'interval' each time) and measures it.
+    Allocations are measured in a second pass, because tracing slows down the tick.
+    """
+    durations = []
+    reads_before, calls_before = backend.state_reads, len(backend.service_calls)
+    for i in range(ticks):
+        backend.now += interval
+        start = time.perf_counter()
+        tick(i)
+        durations.append((time.perf_counter() - start) * 1000)
+    state_reads = (backend.state_reads - reads_before) / ticks
+    service_calls = (len(backend.service_calls) - calls_before) / ticks
+
+    allocations = []
+    tracemalloc.start()
+    for i in range(ticks, ticks + min(ticks, 20)):
+        backend.now += interval
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        tick(i)
+        allocations.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    return {
+        'tick_ms': summarize(durations),
+        'state_reads_per_tick': state_reads,
+        'service_calls_per_tick': service_calls,
+        'alloc_peak_bytes': summarize(allocations),
+    }
+
+
+def bench_solar(devices, ticks):
+    args = {
+        'production_sensor': 'sensor.production',
+        'consumption_sensor': 'sensor.consumption',
+        'battery_percentage_sensor': 'sensor.battery',
+        'excess_buffer': 100,
+        'update_interval': 10,
+        'state_settle_time': 10,
+        'actuation_concurrency': 0,
+        'battery_states': [
+            {'percentage': 10 + i * 80 // devices, 'start': '00:00', 'end': '23:59', 'min_charge_power': 500}
+            for i in range(devices)
+        ],
+        'devices': [
+            {'entity': f'switch.device_{i}', 'consumption': 100 + (i * 37) % 900, 'min_cycle_duration': 30}
+            for i in range(devices)
+        ],
+    }
+    states = {'sensor.production': 0, 'sensor.consumption': 500, 'sensor.battery': 95}
+    states.update({f'switch.device_{i}': 'off' for i in range(devices)})
+    start = time.perf_counter()
+    backend, app = create_app('SolarDeviceController', args, states)
+    startup_ms = (time.perf_counter() - start) * 1000
+
+    total_consumption = sum(device['consumption'] for device in args['devices'])
+
+    def tick(i):
+        # Alternate between enough production for all devices and none at all
+        backend.set_state('sensor.production', total_consumption + 1000 if (i // 5) % 2 else 0)
+        app.loop()
+
+    return {'startup_ms': startup_ms, **measure_ticks(backend, tick, ticks, args['update_interval'])}
+
+
+def bench_rest(ticks, url):
+    args = {
+        'debug': False,
+        'sensor_battery_percentage': 'sensor.battery',
+        'sensor_production': 'sensor.production',
+        'sensor_consumption': 'sensor.consumption',
+        'switch_enable_control': 'input_boolean.enable_control',
+        'switch_enable_battery': 'input_boolean.enable_battery',
+        'switch_limit_percentage': 'input_boolean.limit_percentage',
+        'switch_only_charge': 'input_boolean.only_charge',
+        'switch_only_discharge': 'input_boolean.only_discharge',
+        'battery_charge_limit': 97,
+        'battery_recharge_threshold': 95,
+        'battery_slow_charge_percentage': 90,
+        'battery_slow_charge_max_power': 1500,
+        'url_charge': url + '/charge/{}',
+        'url_discharge': url + '/discharge/{}',
+        'url_headers': {},
+        'refresh_interval': 2,
+    }
+    states = {
+        'sensor.battery': 50, 'sensor.production': 3000, 'sensor.consumption': 500,
+        'input_boolean.enable_control': 'on', 'input_boolean.enable_battery': 'on',
+        'input_boolean.limit_percentage': 'on', 'input_boolean.only_charge': 'off',
+        'input_boolean.only_discharge': 'off',
+    }
+    backend, app = create_app('RestChargeController', args, states)
+
+    def tick(i):
+        backend.set_state('sensor.production', 3000 + (i % 7) * 100)
+        app.loop()
+
+    try:
+        return app, measure_ticks(backend, tick, ticks, args['refresh_interval'])
+    except Exception:
+        app.terminate()
+        raise
+
+
+class StubServer:
+    """
+    Local HTTP server that records when each request has been received.
+    """
+    def __init__(self):
+        received = self.received = {}
+        self.condition = condition = threading.Condition()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                with condition:
+                    received[self.path] = time.perf_counter()
+                    condition.notify_all()
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def wait_for(self, path, timeout=5):
+        with self.condition:
+            self.condition.wait_for(lambda: path in self.received, timeout=timeout)
+            return self.received.get(path)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_command_latency(app, server, commands):
+    """
+    End-to-end latency from calling charge_battery until the request arrives at the server.
+    Also measures how long charge_battery blocks the caller.
+    """
+    latencies = []
+    blocking = []
+    for power in range(1000, 1000 + commands):
+        start = time.perf_counter()
+        app.charge_battery(power)
+        blocking.append((time.perf_counter() - start) * 1000)
+        received = server.wait_for(f'/charge/{power}')
+        if received is not None:
+            latencies.append((received - start) * 1000)
+
+    return {
+        'commands': commands,
+        'delivered': len(latencies),
+        'latency_ms': summarize(latencies) if latencies else None,
+        'call_blocking_ms': summarize(blocking),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the control loops against the simulation backend.")
+    parser.add_argument('--ticks', type=int, default=200, help="ticks per measurement")
+    parser.add_argument('--commands', type=int, default=50, help="charge_battery calls for the latency measurement")
+    parser.add_argument('--output', help="write the results as JSON to this file (default: stdout)")
+    arguments = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'solar_device_controller': {},
+    }
+    for devices in DEVICE_COUNTS:
+        ticks = max(20, arguments.ticks // max(1, devices // 10))
+        results['solar_device_controller'][str(devices)] = bench_solar(devices, ticks)
+
+    server = StubServer()
+    try:
+        app, results['rest_charge_controller'] = bench_rest(arguments.ticks, server.url)
+        try:
+            results['charge_battery'] = bench_command_latency(app, server, arguments.commands)
+        finally:
+            app.terminate()
+    finally:
+        server.close()
+
+    output = json.dumps(results, indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
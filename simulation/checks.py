@@ -0,0 +1,247 @@
+"""
+Deterministic checks of the algorithmic parts of the apps against the simulation backend.
+
+Usage:
+    python -m simulation.checks
+
+Every check builds its own small scenario with known results. The names of the failed checks are printed
+and the exit code is 1 if any check fails.
+"""
+import importlib
+import sys
+import traceback
+from datetime import datetime
+from itertools import combinations
+
+from simulation.backend import install
+from simulation.benchmark import create_app
+from simulation.replay import APPS_DIR
+
+DEVICES = [
+    {'entity': 'switch.large', 'consumption': 1500},
+    {'entity': 'switch.small_1', 'consumption': 1000},
+    {'entity': 'switch.small_2', 'consumption': 1000},
+]
+PLAN_START = 1_699_999_200  # Start of a 15 minute slot
+
+
+def app_module(name):
+    install()
+    if APPS_DIR not in sys.path:
+        sys.path.insert(0, APPS_DIR)
+    return importlib.import_module(name)
+
+
+def run_solar(strategy, production, consumption, states=None, ticks=3, min_cycle_duration=0):
+    """
+    Runs the SolarDeviceController for some ticks with constant production. The devices that are on are added
+    to the consumption (like in the replay).
+
+    :return: the entities that are on afterwards and the service calls
+    """
+    args = {
+        'production_sensor': 'sensor.production',
+        'consumption_sensor': 'sensor.consumption',
+        'allocation_strategy': strategy,
+        'state_settle_time': 0,
+        'device_on_margin': 0,
+        'device_off_margin': 0,
+        'actuation_concurrency': 0,
+        'devices': [dict(device, min_cycle_duration=min_cycle_duration) for device in DEVICES],
+    }
+    initial = {'sensor.production': production, 'sensor.consumption': consumption}
+    initial.update({device['entity']: 'off' for device in DEVICES})
+    initial.update(states or {})
+    backend, app = create_app('SolarDeviceController', args, initial)
+    try:
+        for _ in range(ticks):
+            backend.now += app.update_interval
+            device_consumption = sum(device['consumption'] for device in DEVICES
+                                     if backend.states[device['entity']]['state'] == 'on')
+            backend.set_state('sensor.consumption', consumption + device_consumption)
+            app.loop()
+    finally:
+        app.terminate()
+
+    turned_on = {device['entity'] for device in DEVICES if backend.states[device['entity']]['state'] == 'on'}
+    return turned_on, backend.service_calls
+
+
+def allocation_table(thresholds):
+    """
+    :return: a DeviceTable with devices that are off, unlocked and have the given consumption
+    """
+    module = app_module('SolarDeviceController')
+    table = module.DeviceTable()
+    states = {}
+    for n, threshold in enumerate(thresholds):
+        table.add(f'switch.device_{n}', threshold, True, None, 0, 0)
+        states[f'switch.device_{n}'] = {'state': 'off', 'last_changed': None}
+    table.update(module.StateSnapshot(states, 1_700_000_000.0), datetime.fromisoformat)
+    table.update_thresholds()
+    return table
+
+
+def check_optimal_beats_greedy():
+    # The large device comes first, greedy takes it and nothing else fits anymore
+    greedy, _ = run_solar('greedy', production=2200, consumption=0)
+    optimal, _ = run_solar('optimal', production=2200, consumption=0)
+    assert greedy == {'switch.large'}, greedy
+    assert optimal == {'switch.small_1', 'switch.small_2'}, optimal
+
+
+def check_optimal_keeps_locked_devices():
+    # The large device has just been switched on and cannot be switched off within 'min_cycle_duration',
+    # so its consumption is not available for the two small ones
+    turned_on, service_calls = run_solar('optimal', production=2200, consumption=0,
+                                         states={'switch.large': 'on'}, min_cycle_duration=300)
+    assert turned_on == {'switch.large'}, turned_on
+    assert not service_calls, service_calls
+
+    # After 'min_cycle_duration' the better set is chosen
+    turned_on, _ = run_solar('optimal', production=2200, consumption=0,
+                             states={'switch.large': 'on'}, ticks=35, min_cycle_duration=300)
+    assert turned_on == {'switch.small_1', 'switch.small_2'}, turned_on
+
+    # The allocation itself reports locked devices in their current state: a locked device that is on keeps using
+    # its power and a locked device that is off is not counted
+    allocate_optimal = app_module('SolarDeviceController').allocate_optimal
+    table = allocation_table([1500, 1000, 1000, 200])
+    table.powered_on[0], table.powered_off[0] = True, False
+    table.locked[0] = table.locked[3] = True
+    table.update_thresholds()
+    assert allocate_optimal(table, [0, 1, 2, 3], 2800) == [True, True, False, False]
+
+
+def check_optimal_capacity_rounding():
+    module = app_module('SolarDeviceController')
+    allocate_greedy, allocate_optimal = module.allocate_greedy, module.allocate_optimal
+
+    # Like greedy, a device needs more excess than its threshold. Thresholds are rounded up to the resolution,
+    # so the optimal strategy never switches on a device that greedy would not switch on.
+    for threshold in (1000, 1001, 1009):
+        table = allocation_table([threshold])
+        for excess in range(threshold - 20, threshold + 30):
+            greedy = allocate_greedy(table, [0], excess)[0]
+            optimal = allocate_optimal(table, [0], excess)[0]
+            assert not optimal or greedy, (threshold, excess)
+            if threshold % 10 == 0:
+                assert optimal == greedy, (threshold, excess)
+            assert optimal == (excess > -(-threshold // 10) * 10), (threshold, excess)
+
+    # The excess is used as much as possible, independent of the configured order
+    thresholds = [700, 600, 450, 350, 260]
+    table = allocation_table(thresholds)
+    indices = list(range(len(thresholds)))
+    for excess in range(10, sum(thresholds) + 100, 10):
+        best = max(sum(subset) for size in range(len(thresholds) + 1)
+                   for subset in combinations(thresholds, size) if sum(subset) < excess)
+        wanted = allocate_optimal(table, indices, excess)
+        used = sum(threshold for threshold, on in zip(thresholds, wanted) if on)
+        greedy = sum(threshold for threshold, on in zip(thresholds, allocate_greedy(table, indices, excess)) if on)
+        assert used == best >= greedy, (excess, wanted)
+
+
+def charge_planner():
+    # Stored energy is worth less than the import and more than the export price, so without a price
+    # difference neither buying nor selling energy pays off
+    planner = app_module('RestChargeController').ChargePlanner
+    return planner(capacity=10000, max_charge_power=3000, max_discharge_power=3000, slot_seconds=900, buckets=20,
+                   efficiency=0.95, stored_energy_value=0.2)
+
+
+def plan_slots(prices, net_energy=125):
+    """
+    :return: the slots for ChargePlanner.update with the given import prices and a constant net consumption (Wh)
+    """
+    return [(PLAN_START + n * 900, (price, 0.08, net_energy)) for n, price in enumerate(prices)]
+
+
+def check_planner_recomputes_changed_slots():
+    planner = charge_planner()
+    slots = plan_slots([0.1, 0.1, 0.3, 0.3, 0.4, 0.4, 0.2, 0.2])
+    end = slots[-1][0] + 900
+    assert planner.update(slots, end) == 8
+    assert planner.update(slots, end) == 0
+
+    # A slot only depends on the slots after it
+    rows = dict(planner.rows)
+    changed = list(slots)
+    changed[5] = (slots[5][0], (0.5, 0.08, 250))
+    assert planner.update(changed, end) == 6
+    assert all(planner.rows[slot] is rows[slot] for slot, _ in slots[6:])
+    assert any(planner.rows[slot] is not rows[slot] for slot, _ in slots[:5])
+
+    # The cached rows are the same as a full computation
+    full = charge_planner()
+    full.update(changed, end)
+    assert planner.rows == full.rows
+
+    # Passing time alone costs nothing, the rows of the past are dropped
+    assert planner.update(changed[1:], end) == 0
+    assert slots[0][0] not in planner.rows
+
+    # The end of the horizon changes the cost to go of every slot, the cached rows cannot be used anymore
+    assert planner.update(changed[1:5], changed[5][0]) == 4
+
+
+def check_planner_charges_for_expensive_slots():
+    planner = charge_planner()
+    end = PLAN_START + 8 * 900
+
+    # Without a price difference the battery just follows the consumption
+    planner.update(plan_slots([0.3] * 8), end)
+    assert all(target is None for _, _, targets in planner.rows.values() for target in targets)
+
+    # A cheap slot before expensive ones is used to charge, in the expensive slots the battery covers the
+    # consumption (follows it) instead of charging
+    planner = charge_planner()
+    planner.update(plan_slots([0.1] + [0.4] * 7), end)
+    assert planner.power(PLAN_START, 0) > 0
+    assert planner.power(PLAN_START + 4 * 900, 5000) is None
+
+
+def check_planner_interpolation():
+    planner = charge_planner()
+    assert planner.interpolate([0, 10, 30], 1) == 10
+    assert planner.interpolate([0, 10, 30], 1.5) == 20
+
+    # Following the consumption usually ends between two buckets (here 125 Wh / 0.95 below a bucket of 500 Wh),
+    # its cost is the slot cost plus the interpolated cost to go of the next slot
+    planner.update(plan_slots([0.3] * 8), PLAN_START + 8 * 900)
+    _, cost, targets = planner.rows[PLAN_START]
+    next_cost = planner.rows[PLAN_START + 900][1]
+    stay = 10 - 125 / 0.95 / 500
+    expected = planner.slot_cost((stay - 10) * 500, 125, 0.3, 0.08) + planner.interpolate(next_cost, stay)
+    assert targets[10] is None
+    assert abs(cost[10] - expected) < 1e-9, (cost[10], expected)
+
+
+CHECKS = [
+    check_optimal_beats_greedy,
+    check_optimal_keeps_locked_devices,
+    check_optimal_capacity_rounding,
+    check_planner_recomputes_changed_slots,
+    check_planner_charges_for_expensive_slots,
+    check_planner_interpolation,
+]
+
+
+def main():
+    failed = []
+    for check in CHECKS:
+        try:
+            check()
+        except Exception:
+            failed.append(check.__name__)
+            print(f"FAILED {check.__name__}")
+            traceback.print_exc()
+        else:
+            print(f"ok     {check.__name__}")
+
+    print(f"{len(CHECKS) - len(failed)} of {len(CHECKS)} checks passed")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
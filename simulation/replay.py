@@ -0,0 +1,319 @@
+"""
+Replays recorded time series through an app on a virtual clock and reports what the app did.
+
+Usage:
+    python -m simulation.replay apps/apps.yaml SolarDeviceController data.csv
+
+The time series is a CSV (or Parquet, needs pandas) file with a 'timestamp' column (ISO date or unix time)
+and one column per entity id, e.g. 'sensor.production'. Every row sets the states of the entities at that
+time. Empty cells keep the previous state.
+"""
+import argparse
+import csv
+import importlib
+import json
+import os
+import sys
+from datetime import datetime
+
+from simulation.backend import Backend, install
+
+APPS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'apps')
+
+
+def parse_timestamp(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def load_series(path):
+    """
+    :return: list of (timestamp, {entity_id: state}) sorted by time
+    """
+    if path.endswith('.parquet'):
+        import pandas
+        rows = pandas.read_parquet(path).astype(str).to_dict('records')
+    else:
+        with open(path, newline='') as file:
+            rows = list(csv.DictReader(file))
+
+    series = []
+    for row in rows:
+        timestamp = parse_timestamp(str(row.pop('timestamp')))
+        series.append((timestamp, {entity_id: value for entity_id, value in row.items()
+                                   if value not in (None, '', 'nan', 'None')}))
+    series.sort(key=lambda item: item[0])
+    return series
+
+
+def load_app_config(path, app_name):
+    import yaml
+    with open(path) as file:
+        config = yaml.safe_load(file)
+    return config[app_name]
+
+
+class Simulation:
+    """
+    Runs one app against a recorded time series.
+
+    Models of the environment (derived from the app arguments):
+    - Devices switched by the SolarDeviceController add their consumption (or the given device load) to the
+      consumption sensor and to their 'power_sensor'.
+    - The setpoints of the RestChargeController (all batteries) are added to the grid exchange and, if a
+      battery capacity is given, integrated into the battery percentage (only with a single battery).
+    """
+    def __init__(self, app_name, args, series, initial_states=None, battery_capacity=None, device_loads=None,
+                 hub_args=None, tariff=None, feed_in_price=0):
+        install()
+        if APPS_DIR not in sys.path:
+            sys.path.insert(0, APPS_DIR)
+
+        self.series = series
+        self.backend = Backend(start_time=series[0][0] if series else 0.0)
+        self.args = dict(args)
+        # Service calls are sent directly, the virtual clock does not wait for background threads
+        self.args.setdefault('actuation_concurrency', 0)
+        self.battery_capacity = battery_capacity
+
+        self.consumption_sensor = args.get('consumption_sensor') or args.get('sensor_consumption')
+        self.production_sensor = args.get('production_sensor') or args.get('sensor_production')
+        self.battery_sensor = args.get('battery_percentage_sensor') or args.get('sensor_battery_percentage')
+        self.device_loads = {device['entity']: int(device['consumption']) for device in args.get('devices', [])}
+        self.device_loads.update(device_loads or {})
+        self.power_sensors = {device['entity']: device['power_sensor'] for device in args.get('devices', [])
+                              if 'power_sensor' in device}
+        for entity_id in self.device_loads:
+            self.backend.set_state(entity_id, 'off')
+        for entity_id, state in (initial_states or {}).items():
+            self.backend.set_state(entity_id, state)
+
+        self.base_consumption = 0
+        self.battery_percentage = None
+        self.setpoints = []
+        self.setpoint = 0
+        self.grid_import = 0.0
+        self.grid_export = 0.0
+        self.grid_cost = 0.0
+        self.feed_in_price = feed_in_price
+        self.tariff = None
+        if tariff is not None:
+            from RestChargeController import Profile
+            self.tariff = Profile(tariff)
+
+        # The SensorHub app used by the app (argument 'sensor_hub') runs in the same simulation
+        self.hub = None
+        if args.get('sensor_hub'):
+            import SensorHub
+            self.hub = SensorHub.SensorHub(self.backend, args['sensor_hub'], dict(hub_args or {}))
+
+        module = importlib.import_module(args.get('module', app_name))
+        if hasattr(module, 'ChargeTransport'):
+            module.ChargeTransport = SimulatedTransport
+        self.app = getattr(module, args.get('class', app_name))(self.backend, app_name, self.args)
+
+    def record_setpoints(self):
+        charge_battery = self.app.charge_battery
+
+        battery_setpoints = {}
+
+        def recording_charge_battery(power, battery=None):
+            battery_setpoints[battery] = power
+            self.setpoint = sum(battery_setpoints.values())
+            self.setpoints.append((self.backend.now, power))
+            charge_battery(power, battery)
+
+        self.app.charge_battery = recording_charge_battery
+
+    def update_derived_states(self):
+        if self.consumption_sensor is None:
+            return
+
+        loads = {
+            entity_id: load if self.backend.states.get(entity_id, {}).get('state') == 'on' else 0
+            for entity_id, load in self.device_loads.items()
+        }
+        for entity_id, power_sensor in self.power_sensors.items():
+            if self.backend.states.get(power_sensor, {}).get('state') != str(loads[entity_id]):
+                self.backend.set_state(power_sensor, loads[entity_id])
+
+        device_consumption = sum(loads.values())
+        consumption = str(int(self.base_consumption + device_consumption))
+        if self.backend.states.get(self.consumption_sensor, {}).get('state') != consumption:
+            self.backend.set_state(self.consumption_sensor, consumption)
+
+    def grid_power(self):
+        """
+        :return: grid exchange in W (positive = import)
+        """
+        production = float(self.backend.states.get(self.production_sensor, {}).get('state') or 0)
+        consumption = float(self.backend.states.get(self.consumption_sensor, {}).get('state') or 0)
+        setpoint = self.setpoint
+        # An empty battery cannot discharge and a full one cannot charge
+        if self.battery_percentage is not None and self.battery_capacity is not None:
+            if (setpoint < 0 and self.battery_percentage <= 0) or (setpoint > 0 and self.battery_percentage >= 100):
+                setpoint = 0
+        return consumption - production + setpoint
+
+    def step_battery(self, seconds):
+        if self.battery_capacity is None or self.battery_percentage is None or self.battery_sensor is None:
+            return
+
+        self.battery_percentage += self.setpoint * seconds / 3600 / self.battery_capacity * 100
+        self.battery_percentage = max(0.0, min(100.0, self.battery_percentage))
+        self.backend.set_state(self.battery_sensor, str(int(self.battery_percentage)))
+
+    def apply_row(self, states):
+        for entity_id, state in states.items():
+            if entity_id == self.consumption_sensor:
+                self.base_consumption = float(state)
+                continue
+            if entity_id == self.battery_sensor and self.battery_capacity is not None:
+                if self.battery_percentage is None:
+                    self.battery_percentage = float(state)
+                continue
+            self.backend.set_state(entity_id, state)
+
+        self.update_derived_states()
+
+    def run(self):
+        if not self.series:
+            raise ValueError("The time series is empty")
+
+        # Initial states have to be available for initialize()
+        self.apply_row(self.series[0][1])
+        self.step_battery(0)
+        self.backend.after_callback = self.update_derived_states
+        if self.hub is not None:
+            self.hub.initialize()
+        self.app.initialize()
+        if hasattr(self.app, 'charge_battery'):
+            self.record_setpoints()
+
+        last_time = self.series[0][0]
+        for timestamp, states in self.series[1:]:
+            self.backend.run_until(timestamp)
+
+            seconds = timestamp - last_time
+            grid_energy = self.grid_power() * seconds / 3600
+            if grid_energy > 0:
+                self.grid_import += grid_energy
+            else:
+                self.grid_export -= grid_energy
+            if self.tariff is not None:
+                local_time = datetime.fromtimestamp(last_time)
+                day_start = last_time - (local_time.hour * 3600 + local_time.minute * 60 + local_time.second)
+                price = self.tariff.at(last_time, day_start, 0) if grid_energy > 0 else self.feed_in_price
+                self.grid_cost += grid_energy / 1000 * price
+            self.step_battery(seconds)
+            last_time = timestamp
+
+            self.apply_row(states)
+
+        # Calls the app has deferred (run_in 0) while handling the last row
+        self.backend.run_until(self.series[-1][0])
+
+        if hasattr(self.app, 'terminate'):
+            self.app.terminate()
+        if self.hub is not None:
+            self.hub.terminate()
+
+        return self.report()
+
+    def report(self):
+        toggles = {}
+        script_calls = {}
+        for _, service, kwargs in self.backend.service_calls:
+            entity_ids = kwargs.get('entity_id')
+            for entity_id in ([entity_ids] if isinstance(entity_ids, str) else entity_ids or []):
+                if service.startswith('script/'):
+                    state = (kwargs.get('variables') or {}).get('state')
+                    script_calls[state] = script_calls.get(state, 0) + 1
+                else:
+                    toggles[entity_id] = toggles.get(entity_id, 0) + 1
+
+        setpoints = [power for _, power in self.setpoints]
+        return {
+            'duration_hours': round((self.series[-1][0] - self.series[0][0]) / 3600, 2),
+            'state_reads': self.backend.state_reads,
+            'service_calls': len(self.backend.service_calls),
+            'toggles': toggles,
+            'script_calls': script_calls,
+            'grid_import_kwh': round(self.grid_import / 1000, 3),
+            'grid_export_kwh': round(self.grid_export / 1000, 3),
+            'grid_cost': round(self.grid_cost, 3) if self.tariff is not None else None,
+            'battery_setpoints': {
+                'count': len(setpoints),
+                'min': min(setpoints, default=None),
+                'max': max(setpoints, default=None),
+                'mean_abs_step': round(sum(abs(b - a) for a, b in zip(setpoints, setpoints[1:]))
+                                       / max(1, len(setpoints) - 1), 1),
+            },
+            'battery_percentage': None if self.battery_percentage is None else round(self.battery_percentage, 1),
+        }
+
+
+class SimulatedTransport:
+    """
+    Replaces the HTTP transport of the RestChargeController, nothing is sent.
+    """
+    def __init__(self, ad, *args, **kwargs):
+        self.requests = 0
+
+    def send(self, url):
+        self.requests += 1
+
+    def stop(self):
+        pass
+
+
+def parse_states(values):
+    states = {}
+    for value in values or []:
+        entity_id, _, state = value.partition('=')
+        states[entity_id] = state
+    return states
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded time series through an app.")
+    parser.add_argument('config', help="apps.yaml containing the app configuration")
+    parser.add_argument('app', help="name of the app in the apps.yaml")
+    parser.add_argument('data', help="CSV or Parquet file with the time series")
+    parser.add_argument('--state', action='append', metavar='ENTITY=STATE',
+                        help="initial state of an entity that is not part of the time series (repeatable)")
+    parser.add_argument('--set', action='append', metavar='ARG=VALUE',
+                        help="override an app argument, value is parsed as YAML (repeatable)")
+    parser.add_argument('--device-load', action='append', metavar='ENTITY=W',
+                        help="real consumption of a device if it differs from the configured one (repeatable)")
+    parser.add_argument('--tariff', metavar='FILE',
+                        help="JSON file with the import price per kWh (time -> price), adds the grid cost to the report")
+    parser.add_argument('--feed-in-price', type=float, default=0, help="export price per kWh for the grid cost")
+    parser.add_argument('--battery-capacity', type=float, metavar='WH',
+                        help="simulate the battery percentage from the setpoints instead of using the recorded one")
+    arguments = parser.parse_args()
+
+    import yaml
+    args = load_app_config(arguments.config, arguments.app)
+    for name, value in parse_states(arguments.set).items():
+        args[name] = yaml.safe_load(value)
+
+    config = None
+    if args.get('sensor_hub'):
+        config = load_app_config(arguments.config, args['sensor_hub'])
+
+    simulation = Simulation(arguments.app, args, load_series(arguments.data),
+                            initial_states=parse_states(arguments.state),
+                            battery_capacity=arguments.battery_capacity,
+                            device_loads={entity_id: float(load)
+                                          for entity_id, load in parse_states(arguments.device_load).items()},
+                            hub_args=config,
+                            tariff=json.load(open(arguments.tariff)) if arguments.tariff else None,
+                            feed_in_price=arguments.feed_in_price)
+    print(json.dumps(simulation.run(), indent=2))
+
+
+if __name__ == '__main__':
+    main()